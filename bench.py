@@ -0,0 +1,300 @@
+"""Benchmarks for Dark Dungeon, run without a window or audio.
+
+    python bench.py generation [--levels 100] [--repeat 5] [--seed 1]
+    python bench.py restart [--repeat 100] [--seed 1]
+    python bench.py suite [--repeat 5] [--seed 1] [--output PATH]
+                          [--baseline PATH] [--threshold [NAME=]PERCENT ...]
+
+The suite times the engine's hot paths with fixed seeds. Its results can be saved
+as JSON and compared against a saved baseline. bench.py then exits with status 1
+if any benchmark got slower than its threshold allows.
+"""
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+import rogue
+
+
+SUITE_LEVELS = [1, 10, 50, 100]  # Dungeon levels generate_dungeon is timed at
+SUITE_RADII = [3, 6, 10, 15]  # Vision radii update_fov is timed at
+SUITE_ENEMIES = [10, 100, 1000]  # Enemies chasing the player for move_enemies
+COMBAT_CALLS = 5000  # calculate_damage and fight calls per timed run
+ENEMY_TURNS = 10  # move_enemies calls per timed run
+CALLS = 20  # Calls per timed run of the faster benchmarks (update_fov, draw_ui, draw_minimap)
+DEFAULT_THRESHOLD = 10  # Percent slower than the baseline that counts as a regression
+
+
+
+def bench_generation(levels=100, repeat=5, seed=1):
+    """Time generate_dungeon at every dungeon level from 1 to levels; returns {level: ms}"""
+    rogue.sprite_cache.enabled = False
+    game = rogue.Game(seed=seed)
+    results = {}
+    for level in range(1, levels + 1):
+        game.dungeon_level = level
+        game.rng.seed(seed * 1000 + level)  # Same layouts whatever levels were run before
+        times = []
+        for _ in range(repeat):
+            game.wait_for_next_level()  # Not competing with the last generation's prefetch
+            start = time.perf_counter()
+            game.generate_dungeon()
+            times.append(time.perf_counter() - start)
+        results[level] = sum(times) / repeat * 1000
+    return results
+
+
+
+def report_generation(results):
+    print(f"{'level':>5} {'ms':>8}")
+    for level, ms in results.items():
+        if level == 1 or level % 10 == 0:
+            print(f"{level:>5} {ms:>8.2f}")
+    print(f"mean {sum(results.values()) / len(results):.2f} ms, "
+          f"slowest {max(results.values()):.2f} ms (level {max(results, key=results.get)})")
+
+
+
+def bench_restart(repeat=100, seed=1):
+    """Time pressing R: Game.reset plus the full redraw that follows; returns the times in ms"""
+    rogue.init_display()
+    rogue.init_fonts()
+    game = rogue.Game(seed=seed)
+    game.update_camera()
+    game.draw()
+    times = []
+    for _ in range(repeat):
+        game.wait_for_next_level()
+        start = time.perf_counter()
+        game.reset()
+        game.presenter.invalidate_all()
+        game.update_camera()
+        game.draw()
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+
+def report_restart(times):
+    times = sorted(times)
+    frame = 1000 / rogue.FPS
+    print(f"restart: median {times[len(times) // 2]:.2f} ms, slowest {times[-1]:.2f} ms "
+          f"(one frame is {frame:.1f} ms)")
+
+
+
+def best_ms(run, repeat, setup=None, number=1):
+    """Fastest time in ms of number calls to run(), over repeat runs; setup() runs untimed before each
+
+    The fastest run is the one least disturbed by the rest of the machine, as timeit advises.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            run()
+        times.append((time.perf_counter() - start) * 1000)
+    return min(times)
+
+
+
+def floor_tiles_by_distance(game):
+    """Floor tiles of the level other than the player's, nearest to the player first"""
+    px, py = game.player.x, game.player.y
+    floor = [(x, y) for y in range(game.map_height) for x in range(game.map_width)
+             if game.tiles.type[y, x] != 0 and (x, y) != (px, py)]
+    floor.sort(key=lambda tile: (max(abs(tile[0] - px), abs(tile[1] - py)), tile[1], tile[0]))
+    return floor
+
+
+
+def bench_suite(repeat=5, seed=1):
+    """Run every benchmark of the suite; returns {name: fastest ms}"""
+    rogue.init_display()
+    rogue.init_fonts()
+    results = {}
+    game = rogue.Game(seed=seed)
+
+    # Level generation, the same layout at every repeat
+    for level in SUITE_LEVELS:
+        def setup():
+            game.wait_for_next_level()
+            game.dungeon_level = level
+            game.rng.seed(seed * 1000 + level)
+        results[f"generate_dungeon/level_{level}"] = best_ms(game.generate_dungeon, repeat, setup)
+
+    # Field of view, computed from scratch rather than taken from the FOV cache
+    game.dungeon_level = 1
+    game.rng.seed(seed)
+    game.generate_dungeon()
+    game.wait_for_next_level()  # Nothing below runs alongside the prefetch worker
+    for radius in SUITE_RADII:
+        game.player.vision_radius = radius
+
+        def run():
+            game.fov_cache.clear()
+            game.update_fov()
+        results[f"update_fov/radius_{radius}_calls_{CALLS}"] = best_ms(run, repeat, number=CALLS)
+
+    # Enemy turns: count enemies on the floor tiles nearest the player, all in agro range.
+    # Neither side can die, so every enemy takes every turn and those that reach the player
+    # keep fighting. The player doesn't move either, so the chase map is dropped to be
+    # rebuilt every turn as in play.
+    floor = floor_tiles_by_distance(game)
+    archetype = rogue.enemy_archetype(0, 1)
+    for count in SUITE_ENEMIES:
+        def setup():
+            game.rng.seed(seed)
+            for enemy in list(game.entities.handles):
+                game.remove_entity(enemy)
+            for x, y in floor[:count]:
+                game.add_entity(x, y, 0, 10 ** 9, 10 ** 9, 3, 1, 5, archetype)
+            game.enemy_agro_range = 30
+            game.player.hp = game.player.max_hp = 10 ** 9
+
+        def run():
+            game.chase_key = None
+            game.move_enemies()
+        results[f"move_enemies/enemies_{count}_turns_{ENEMY_TURNS}"] = best_ms(run, repeat, setup, ENEMY_TURNS)
+
+    # Combat against a ghost (dodges and drains life) that is too tough to die
+    game.rng.seed(seed)
+    for enemy in list(game.entities.handles):
+        game.remove_entity(enemy)
+    x, y = floor[0]
+    enemy = game.add_entity(x, y, 5, 10 ** 9, 10 ** 9, 3, 1, 5, rogue.enemy_archetype(5, 20))
+    game.player.hp = game.player.max_hp = 10 ** 9
+
+    def run():
+        game.calculate_damage(game.player, enemy)
+        game.calculate_damage(enemy, game.player)
+    results[f"calculate_damage/calls_{2 * COMBAT_CALLS}"] = best_ms(run, repeat, number=COMBAT_CALLS)
+    results[f"fight/calls_{COMBAT_CALLS}"] = best_ms(lambda: game.fight(enemy), repeat, number=COMBAT_CALLS)
+
+    # Drawing: a full frame, then the UI panel and the minimap alone
+    game.remove_entity(enemy)
+    game.update_camera()
+    results["draw/frame"] = best_ms(game.draw, repeat, game.presenter.invalidate_all)
+    results[f"draw/ui_calls_{CALLS}"] = best_ms(game.draw_ui, repeat, number=CALLS)
+    results[f"draw/minimap_calls_{CALLS}"] = best_ms(game.draw_minimap, repeat, number=CALLS)
+
+    # Cold startup: a new interpreter importing the game and drawing the first frame
+    script = ("import rogue; rogue.init_display(); rogue.init_fonts(); "
+              f"game = rogue.Game(seed={seed}); game.update_camera(); game.draw()")
+    command = [sys.executable, "-c", script]
+    directory = os.path.dirname(os.path.abspath(rogue.__file__))
+    results["startup/cold"] = best_ms(
+        lambda: subprocess.run(command, cwd=directory, check=True, capture_output=True), repeat)
+    return results
+
+
+
+def suite_report(results, repeat, seed):
+    """Results as saved by --output: the times plus what they were measured on"""
+    return {
+        "seed": seed,
+        "repeat": repeat,
+        "python": platform.python_version(),
+        "pygame": rogue.pygame.version.ver,
+        "numpy": rogue.np.__version__,
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+
+def threshold(text):
+    """Parse a --threshold value: PERCENT, or NAME=PERCENT for the benchmarks starting with NAME"""
+    name, _, percent = text.rpartition("=")
+    try:
+        percent = float(percent)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid threshold: {text!r}")
+    return name, percent
+
+
+
+def compare_suite(results, baseline, thresholds):
+    """Print results next to baseline; returns the names of the benchmarks that regressed
+
+    thresholds is a list of (name prefix, percent), the longest matching prefix winning.
+    """
+    limits = sorted(thresholds, key=lambda limit: len(limit[0]))
+    regressions = []
+    print(f"{'benchmark':<36} {'baseline':>9} {'now':>9} {'change':>8} {'limit':>7}")
+    for name, ms in results.items():
+        if name not in baseline:
+            print(f"{name:<36} {'-':>9} {ms:>9.2f}")
+            continue
+        allowed = DEFAULT_THRESHOLD
+        for prefix, percent in limits:
+            if name.startswith(prefix):
+                allowed = percent
+        change = (ms / baseline[name] - 1) * 100 if baseline[name] else 0
+        regressed = change > allowed
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<36} {baseline[name]:>9.2f} {ms:>9.2f} {change:>+7.1f}% {allowed:>6.0f}%"
+              + ("  SLOWER" if regressed else ""))
+    return regressions
+
+
+
+def report_suite(results):
+    print(f"{'benchmark':<36} {'ms':>9}")
+    for name, ms in results.items():
+        print(f"{name:<36} {ms:>9.2f}")
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dark Dungeon benchmarks")
+    parser.add_argument("benchmark", choices=["generation", "restart", "suite"], help="what to measure")
+    parser.add_argument("--levels", type=int, default=100, help="deepest dungeon level to generate")
+    parser.add_argument("--repeat", type=int,
+                        help="generations timed per level (default 5), restarts (100) or suite runs (5)")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the random number generator")
+    parser.add_argument("--output", metavar="PATH", help="suite: save the results to PATH as JSON")
+    parser.add_argument("--baseline", metavar="PATH", help="suite: compare with results saved by --output")
+    parser.add_argument("--threshold", type=threshold, action="append", default=[], metavar="[NAME=]PERCENT",
+                        help="suite: how much slower than the baseline counts as a regression, for every "
+                             f"benchmark or those starting with NAME (default {DEFAULT_THRESHOLD}%%)")
+    args = parser.parse_args(argv)
+
+    if args.benchmark == "generation":
+        report_generation(bench_generation(args.levels, args.repeat or 5, args.seed))
+    elif args.benchmark == "restart":
+        report_restart(bench_restart(args.repeat or 100, args.seed))
+    elif args.benchmark == "suite":
+        baseline = None
+        if args.baseline:
+            try:
+                with open(args.baseline) as f:
+                    baseline = json.load(f)["results"]
+            except (OSError, ValueError, KeyError) as e:
+                parser.error(f"can't read baseline {args.baseline}: {e}")
+
+        repeat = args.repeat or 5
+        results = bench_suite(repeat, args.seed)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(suite_report(results, repeat, args.seed), f, indent=2)
+
+        if baseline is None:
+            report_suite(results)
+        elif compare_suite(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+
+if __name__ == "__main__":
+    main()
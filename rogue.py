@@ -1,11 +1,41 @@
-import pygame
+import time
+_IMPORT_START = time.perf_counter()  # Start of the startup trace
+
+import os
+import mmap
 import random
 import sys
 import math
+import json
 import base64
+import hashlib
+import argparse
+import operator
+import threading
+import importlib.util
+from array import array
+from contextlib import contextmanager
+from collections import deque, OrderedDict
 from io import BytesIO
-from pygame.locals import *
-from PIL import Image
+
+
+
+def lazy_import(name):
+    """Import a module on first attribute access instead of at import time"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+# Heavy libraries are only loaded once something actually uses them
+pygame = lazy_import("pygame")
+np = lazy_import("numpy")
 
 # Base64 images
 PLAYER_IMAGE = "iVBORw0KGgoAAAANSUhEUgAAACAAAAAgCAYAAABzenr0AAAACXBIWXMAAA7DAAAOwwHHb6hkAAAKT2lDQ1BQaG90b3Nob3AgSUNDIHByb2ZpbGUAAHjanVNnVFPpFj333vRCS4iAlEtvUhUIIFJCi4AUkSYqIQkQSoghodkVUcERRUUEG8igiAOOjoCMFVEsDIoK2AfkIaKOg6OIisr74Xuja9a89+bN/rXXPues852zzwfACAyWSDNRNYAMqUIeEeCDx8TG4eQuQIEKJHAAEAizZCFz/SMBAPh+PDwrIsAHvgABeNMLCADATZvAMByH/w/qQplcAYCEAcB0kThLCIAUAEB6jkKmAEBGAYCdmCZTAKAEAGDLY2LjAFAtAGAnf+bTAICd+Jl7AQBblCEVAaCRACATZYhEAGg7AKzPVopFAFgwABRmS8Q5ANgtADBJV2ZIALC3AMDOEAuyAAgMADBRiIUpAAR7AGDIIyN4AISZABRG8lc88SuuEOcqAAB4mbI8uSQ5RYFbCC1xB1dXLh4ozkkXKxQ2YQJhmkAuwnmZGTKBNA/g88wAAKCRFRHgg/P9eM4Ors7ONo62Dl8t6r8G/yJiYuP+5c+rcEAAAOF0ftH+LC+zGoA7BoBt/qIl7gRoXgugdfeLZrIPQLUAoOnaV/Nw+H48PEWhkLnZ2eXk5NhKxEJbYcpXff5nwl/AV/1s+X48/Pf14L7iJIEyXYFHBPjgwsz0TKUcz5IJhGLc5o9H/LcL//wd0yLESWK5WCoU41EScY5EmozzMqUiiUKSKcUl0v9k4t8s+wM+3zUAsGo+AXuRLahdYwP2SycQWHTA4vcAAPK7b8HUKAgDgGiD4c93/+8//UegJQCAZkmScQAAXkQkLlTKsz/HCAAARKCBKrBBG/TBGCzABhzBBdzBC/xgNoRCJMTCQhBCCmSAHHJgKayCQiiGzbAdKmAv1EAdNMBRaIaTcA4uwlW4Dj1wD/phCJ7BKLyBCQRByAgTYSHaiAFiilgjjggXmYX4IcFIBBKLJCDJiBRRIkuRNUgxUopUIFVIHfI9cgI5h1xGupE7yAAygvyGvEcxlIGyUT3UDLVDuag3GoRGogvQZHQxmo8WoJvQcrQaPYw2oefQq2gP2o8+Q8cwwOgYBzPEbDAuxsNCsTgsCZNjy7EirAyrxhqwVqwDu4n1Y8+xdwQSgUXACTYEd0IgYR5BSFhMWE7YSKggHCQ0EdoJNwkDhFHCJyKTqEu0JroR+cQYYjIxh1hILCPWEo8TLxB7iEPENyQSiUMyJ7mQAkmxpFTSEtJG0m5SI+ksqZs0SBojk8naZGuyBzmULCAryIXkneTD5DPkG+Qh8lsKnWJAcaT4U+IoUspqShnlEOU05QZlmDJBVaOaUt2ooVQRNY9aQq2htlKvUYeoEzR1mjnNgxZJS6WtopXTGmgXaPdpr+h0uhHdlR5Ol9BX0svpR+iX6AP0dwwNhhWDx4hnKBmbGAcYZxl3GK+YTKYZ04sZx1QwNzHrmOeZD5lvVVgqtip8FZHKCpVKlSaVGyovVKmqpqreqgtV81XLVI+pXlN9rkZVM1PjqQnUlqtVqp1Q61MbU2epO6iHqmeob1Q/pH5Z/YkGWcNMw09DpFGgsV/jvMYgC2MZs3gsIWsNq4Z1gTXEJrHN2Xx2KruY/R27iz2qqaE5QzNKM1ezUvOUZj8H45hx+Jx0TgnnKKeX836K3hTvKeIpG6Y0TLkxZVxrqpaXllirSKtRq0frvTau7aedpr1Fu1n7gQ5Bx0onXCdHZ4/OBZ3nU9lT3acKpxZNPTr1ri6qa6UbobtEd79up+6Ynr5egJ5Mb6feeb3n+hx9L/1U/W36p/VHDFgGswwkBtsMzhg8xTVxbzwdL8fb8VFDXcNAQ6VhlWGX4YSRudE8o9VGjUYPjGnGXOMk423GbcajJgYmISZLTepN7ppSTbmmKaY7TDtMx83MzaLN1pk1mz0x1zLnm+eb15vft2BaeFostqi2uGVJsuRaplnutrxuhVo5WaVYVVpds0atna0l1rutu6cRp7lOk06rntZnw7Dxtsm2qbcZsOXYBtuutm22fWFnYhdnt8Wuw+6TvZN9un2N/T0HDYfZDqsdWh1+c7RyFDpWOt6azpzuP33F9JbpL2dYzxDP2DPjthPLKcRpnVOb00dnF2e5c4PziIuJS4LLLpc+Lpsbxt3IveRKdPVxXeF60vWdm7Obwu2o26/uNu5p7ofcn8w0nymeWTNz0MPIQ+BR5dE/C5+VMGvfrH5PQ0+BZ7XnIy9jL5FXrdewt6V3qvdh7xc+9j5yn+M+4zw33jLeWV/MN8C3yLfLT8Nvnl+F30N/I/9k/3r/0QCngCUBZwOJgUGBWwL7+Hp8Ib+OPzrbZfay2e1BjKC5QRVBj4KtguXBrSFoyOyQrSH355jOkc5pDoVQfujW0Adh5mGLw34MJ4WHhVeGP45wiFga0TGXNXfR3ENz30T6RJZE3ptnMU85ry1KNSo+qi5qPNo3ujS6P8YuZlnM1VidWElsSxw5LiquNm5svt/87fOH4p3iC+N7F5gvyF1weaHOwvSFpxapLhIsOpZATIhOOJTwQRAqqBaMJfITdyWOCnnCHcJnIi/RNtGI2ENcKh5O8kgqTXqS7JG8NXkkxTOlLOW5hCepkLxMDUzdmzqeFpp2IG0yPTq9MYOSkZBxQqohTZO2Z+pn5mZ2y6xlhbL+xW6Lty8elQfJa7OQrAVZLQq2QqboVFoo1yoHsmdlV2a/zYnKOZarnivN7cyzytuQN5zvn//tEsIS4ZK2pYZLVy0dWOa9rGo5sjxxedsK4xUFK4ZWBqw8uIq2Km3VT6vtV5eufr0mek1rgV7ByoLBtQFr6wtVCuWFfevc1+1dT1gvWd+1YfqGnRs+FYmKrhTbF5cVf9go3HjlG4dvyr+Z3JS0qavEuWTPZtJm6ebeLZ5bDpaql+aXDm4N2dq0Dd9WtO319kXbL5fNKNu7g7ZDuaO/PLi8ZafJzs07P1SkVPRU+lQ27tLdtWHX+G7R7ht7vPY07NXbW7z3/T7JvttVAVVN1WbVZftJ+7P3P66Jqun4lvttXa1ObXHtxwPSA/0HIw6217nU1R3SPVRSj9Yr60cOxx++/p3vdy0NNg1VjZzG4iNwRHnk6fcJ3/ceDTradox7rOEH0x92HWcdL2pCmvKaRptTmvtbYlu6T8w+0dbq3nr8R9sfD5w0PFl5SvNUyWna6YLTk2fyz4ydlZ19fi753GDborZ752PO32oPb++6EHTh0kX/i+c7vDvOXPK4dPKy2+UTV7hXmq86X23qdOo8/pPTT8e7nLuarrlca7nuer21e2b36RueN87d9L158Rb/1tWeOT3dvfN6b/fF9/XfFt1+cif9zsu72Xcn7q28T7xf9EDtQdlD3YfVP1v+3Njv3H9qwHeg89HcR/cGhYPP/pH1jw9DBY+Zj8uGDYbrnjg+OTniP3L96fynQ89kzyaeF/6i/suuFxYvfvjV69fO0ZjRoZfyl5O/bXyl/erA6xmv28bCxh6+yXgzMV70VvvtwXfcdx3vo98PT+R8IH8o/2j5sfVT0Kf7kxmTk/8EA5jz/GMzLdsAAAAgY0hSTQAAeiUAAICDAAD5/wAAgOkAAHUwAADqYAAAOpgAABdvkl/FRgAABl1JREFUeNrkl1tsFOcVx3/fzM54vWtsDMYXsGMMlmocgh3ACSbcgkihlCYRaZoWQhopUR6atjRqqFoeSmVVVauKkKiCSMSQIFpoEeAAcQMY2YkBhWKM3Zpyp2yx8d1rs17vdWZOHyCkFBu5pigP/aTvZY7O+c6c/7n8jxIRvsyj8SUf1/0oz/naO5Ix6RUcOwJKIWLT3byLaPAydZ++rYZjQ40UgtmL35WxOS9gxQcAhVI6iJ8/b3tYPfAILP32j6Rk8RvYVvvNv1CglI7vgnVPvY3L5kl3zGbd4ePqv3agdOl3ZPLEYszUSaRkl9DRUn1blmgqTJfG2DQvUDSo/q+WzJECr4FXjTAJA5FCKj/oo+fwVfJ9XWSd72Cyr4+pbQM0/KmZP6y/QKCjm5Xf//WgmIYsBwVEHXtkDqj2WsZlt4DrIsseb2PD6oksLGpBXFUsLw0zJS+JoxXtfLJHZ/qPdw3qhCPC9ZiMzIEzZ6uUprfzz5YeOtt7wdZobuvh/IVrPDtNmJZtkppxmLHpu4n/5f279L0uDbeu0xW17q8KPq38q8xPvg6XLmPnF+CMn0BkIMLzr9cS0A4THeikvr7+rkpYXDJdipMTONYb4fjphi/kInLHLZy1QKYufFr+/duWD/fLvhN18l5FhXSISGtrq/R9VistnZ1yRUQu2yIb3j8lJ670yptlZfKfNj+/L5TOuEt2RxU89swqebqsnL17api67FU581G5AhiVksTcx2cSYSYDMRtJzyKUmYWyBRWzUcCKl2cQsW1u+PuGDt8g0b4jB5IXvUJrzce0VmwloDIpXrdLlFKy5vXfcrLJwrllQNk2WtxGOc5t3bAlWHGLYCBA8cynBsU1KzGBr8+bJ0M2onDLP3BfPYeYbsKOEPR389i8WSx/6XvEbcFxhs4Xx3FIdBuUb3mPI6ehZO4qqTu6XZWUPifPzlpCd/NB3nzmq0QSPUN3wrWFyYxJn0zN330smTmJHW29pJv5zF20jIJc6IvZmKZCAbFb5WSaCgNF1HE4dDjIjRvCQPt5cqb8lJL5b4g3r4yTvuvs++5z+INx1uw4xo7XhoCg9sA2clM0Nq+azfo5KazJzyBoL+Xt9W3UNUVJN3Ua6sI0NoRxmxpuU3H86ABbt/kJ9AnjxrjY+W4N27c2E4m6yX1kHTgGwWv1QARfV5g63xOULn5LBo3Ab3YfUGtfe0synNGcbLpEyMgj7ytP0dcXZsvvTtNQZODrmUwsEiUz00Wv32bvniCdnUI0FsIV+hvuBJvRjzyK4U4gHgti6EJbP2yoaCPL1YbHfBRxwkMPo6prk7lyqpFYZIC08SkUPRnB49Ho6kpgW/klxGokOSOf32+fSjBgcbG+gXiogx1NCtOTQk7hdNyJyVjxECAkJrpxZRWzueoQ38w9C04RmitpaAeSEtwkqiip6WnkTClGHBtRLlKz8nAZOv6WS4xK8XDubBilhKTRSYRVlMRRGmkTH0Y3dK6eK2fchEW4PVmgbDLzp2F4/KSaAUYFQxz7eLUashMWl3xDRqW9ijs5D29qGpqWSHf7MQL9LUzIX4FBGMexceybLVXXDZSmgQiOQCge50zty0wtKSMppQDb6sfWkhjv6oHzP6C8ukrdcxY01h1Q/V3v0Nu2CcMYi7+1kqDvF4zp3siy8HZ6HS8hJ4Go8hJVXkKOSTCkEQga2JZiQeda2i9XqyM756h4pAOXkUIsdI3yTQUqFPEPj5A0nqpWAMUzFkhj/ScKXgTgwxfXyC8HVqLEQSEICmzBXv4QdkEqxh99fHTdfdtO5Qefs6MxI2NENx//4hz0rGC6sx8b/XZnDSsPzxfV8tC0z9hXvYSmlpfuNdRHTskWLt8l7rQFXPT+EBBAYSudb/Vv5NDu2cw/eIMTzbOIJGUza9HP5cSRsmFxw2HzgdFZS9CdMF4J4JV+PNKPRwZ4Il5J8Jyiu8bA6+9CMzTSclb+7/cCx44OGkILE8O0ML0W6DdxsWL+B8CKlbrlgNxGU8Nip3c1vfo4fK4pdOjZJBDGfhC0XFMmjmYhjg23ntDEocksRceiRc/HJXFMiWMPEVil1Mgh2LspWe3fnKnor0bpXpTmQikNNxFcYpEgEXRsROko3Rg23up+ltOSBT+RnMKfYVlhREDTdMSOsL88d9jbkfq/347/NQC2jgUiCOfh7QAAAABJRU5ErkJggg=="
@@ -38,28 +68,11 @@ GOLD_IMAGE="iVBORw0KGgoAAAANSUhEUgAAAEAAAABACAYAAACqaXHeAAAACXBIWXMAAAsTAAALEwEA
 
 
 
-# Initialize pygame
-pygame.init()
-pygame.font.init()
-
-
-
-# Add background music
-pygame.mixer.init()
-try:
-    pygame.mixer.music.load("background_music.mp3")  # Place your music file in the same folder
-    pygame.mixer.music.set_volume(0.4)  # Adjust volume as needed
-    pygame.mixer.music.play(-1)  # Loop indefinitely
-except Exception as e:
-    print(f"Could not load background music: {e}")
-
-
-
-
 # Game settings
 SCREEN_WIDTH, SCREEN_HEIGHT = 2048, 1536
 GRID_SIZE = 64
 FPS = 60
+MAP_SIZE = 100  # Classic level size; larger maps are generated chunk by chunk as the player explores
 
 
 
@@ -68,6 +81,7 @@ MINIMAP_WIDTH = 300
 MINIMAP_HEIGHT = 300
 MINIMAP_CELL_SIZE = 3
 MINIMAP_POSITION = (SCREEN_WIDTH - MINIMAP_WIDTH - 10, 10)
+PROFILER_RECT = (10, 250, 300, 235)  # F3 frame timings overlay, below the combat log
 
 
 
@@ -155,23 +169,469 @@ FLOOR_PALETTE = [
 
 
 
-# Create screen
-screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
-pygame.display.set_caption("Dark Dungeon")
-clock = pygame.time.Clock()
+# Longest the event-driven loop sleeps without input (ms)
+IDLE_WAKEUP = 1000
+
+# Extra tiles around the agro range the enemy distance map covers, so chasers can path around walls
+CHASE_MARGIN = 5
+
+# Chunks of large maps get generated once the player is within vision radius + this many tiles
+CHUNK_MARGIN = 10
+
+
+
+# Enemy kinds, indexed by the enemy type rolled in LevelBuilder.place_entities
+ENEMY_TYPES = ["goblin", "orc", "skeleton", "zombie", "troll", "ghost"]
+ENEMY_CHARS = ["g", "o", "s", "z", "T", "G"]
+ENEMY_COLORS = [GREEN, GREEN, WHITE, WHITE, GREEN, PURPLE]
+
+# Enemy stats rolled by LevelBuilder.place_entities, in this order: hp, attack,
+# defense and exp, each as (low, high, per level) for
+# randint(low, high) + per level * (dungeon level - 1)
+ENEMY_STATS = [
+    ((25, 35, 2), (3, 6, 1), (0, 2, 1), (8, 15, 1)),  # Goblin: fast but weak
+    ((35, 45, 5), (11, 15, 2), (2, 4, 1), (15, 30, 2)),  # Orc: strong warrior, +5 attack
+    ((20, 25, 2), (5, 8, 1), (1, 3, 1), (10, 20, 1)),  # Skeleton: fragile but accurate and dodgy
+    ((30, 40, 6), (4, 7, 1), (3, 5, 1), (12, 22, 1)),  # Zombie: slow but tanky
+    ((35, 50, 8), (7, 12, 2), (2, 4, 1), (25, 40, 3)),  # Troll: regenerating brute
+    ((20, 30, 3), (5, 9, 1), (6, 8, 1), (20, 35, 2)),  # Ghost: ethereal and hard to hit, +2 defense
+]
+
+# Special abilities of each enemy kind (see enemy_special)
+ENEMY_SPECIALS = [
+    {"double_attack_chance": 0.2},  # 20% chance to attack twice
+    {"crit_chance": 0.15, "crit_multiplier": 1.5},  # 15% chance of 1.5x damage
+    {"accuracy_bonus": 2, "dodge_chance": 0.15},  # +2 to hit, 15% chance to dodge
+    {"poison_chance": 0.3, "poison_damage": 2, "poison_duration": 3},  # 30% chance of 2 damage for 3 turns
+    {"regeneration": True, "regen_amount": 3},  # Plus the dungeon level per turn
+    {"dodge_chance": 0.25, "life_drain": 0.25},  # Heals by a quarter of the damage dealt
+]
+
+# Item kinds as (char, color, name, effect)
+ITEM_KINDS = [
+    ("$", GOLD, "Gold", "gold"),
+    ("T", YELLOW, "Treasure", "gold"),
+    ("H", RED, "Health Potion", "heal"),
+    ("W", BLUE, "Weapon", "attack"),
+    ("A", BLUE, "Armor", "defense"),
+]
+
+# Special abilities an enemy can have, with the type of their value
+SPECIAL_ABILITIES = [
+    ("double_attack_chance", float),
+    ("crit_chance", float),
+    ("crit_multiplier", float),
+    ("accuracy_bonus", int),
+    ("dodge_chance", float),
+    ("poison_chance", float),
+    ("poison_damage", int),
+    ("poison_duration", int),
+    ("regeneration", bool),
+    ("regen_amount", int),
+    ("life_drain", float),
+]
+
+# Game events as kind -> (message, combat log line). Events are recorded as plain
+# (kind, actor, target, amount, extra) tuples and only turned into text when the
+# HUD draws them (see EventLog); kinds without a log line only show as the message.
+EVENT_TEXT = {
+    "blocked": ("You can't go that way!", None),
+    "wall": ("You can't walk through walls!", None),
+    "descend": ("Descending to dungeon level {amount}...", None),
+    "loaded": ("Game loaded", None),
+    "hit": ("You hit {target} for {amount} damage!", "You hit {target} for {amount} damage!"),
+    "dodged": ("{target} dodged your attack!", "{target} dodged your attack!"),
+    "defeated": ("You defeated {target}! Gained {amount} XP.", "You defeated {target}! Gained {amount} XP."),
+    "level_up": ("Level up! You are now level {amount}! Enemies notice you from farther away!",
+                 "Level up! You are now level {amount}! Enemies notice you from farther away!"),
+    "evaded": ("You dodged {actor}'s attack!", "You dodged {actor}'s attack!"),
+    "hurt": ("{actor} hits you for {amount} damage!", "{actor} hits you for {amount} damage!"),
+    "killed": ("You have been defeated! Press R to restart", None),
+    "critical": ("Critical hit!", "Critical hit!"),
+    "enemy_critical": ("{actor} lands a critical hit!", "{actor} lands a critical hit!"),
+    "drain": ("{actor} drains {amount} health!", "{actor} drains {amount} health!"),
+    "poisoned": ("You were poisoned by {actor}!", "Poisoned! {amount} damage per turn for {extra} turns"),
+    "regenerate": ("{actor} regenerates {amount} HP!", "{actor} regenerates {amount} HP"),
+    "double_attack": ("{actor} attacks twice!", "{actor} attacks twice!"),
+    "poison": ("You take {amount} poison damage! ({extra} turns remaining)", "Poison damage: -{amount} HP"),
+    "poison_ended": ("The poison has worn off!", "Poison effect ended"),
+    "poison_killed": ("You have been defeated by poison! Press R to restart", None),
+    "treasure": ("You found a treasure chest with {amount} gold! (Total: {extra})", "Found treasure worth {amount} gold"),
+    "gold": ("You picked up {amount} gold! (Total: {extra})", "Picked up {amount} gold"),
+    "heal": ("You used {target} and healed {amount} HP!", "You used {target} and healed {amount} HP!"),
+    "attack": ("You equipped {target}! Attack + {amount}.", "You equipped {target}! Attack + {amount}."),
+    "defense": ("You equipped {target}! Defense + {amount} and max HP + {extra}.",
+                "You equipped {target}! Defense + {amount} and max HP + {extra}."),
+}
+
+# How long the latest message stays on screen (ms)
+MESSAGE_DURATION = 3000
+
+# How long an enemy's health bar stays up after it was hit or came close (ms)
+HEALTH_BAR_DURATION = 2000
+
+
+
+# Save files: a header, the player, the tile types as two bit planes, the
+# explored bitsets, then fixed-width enemy and item records. All little-endian
+# and unpadded, so that a file can be read straight out of a memory map.
+SAVE_MAGIC = b"DDSV"
+SAVE_VERSION = 1
+SAVE_HEADER = [
+    ("magic", "S4"), ("version", "<u2"),
+    ("width", "<u2"), ("height", "<u2"), ("dungeon_level", "<u2"),
+    ("enemies", "<u4"), ("items", "<u4"),
+    ("exit_x", "<u2"), ("exit_y", "<u2"),
+    ("exit_chunk_x", "<i2"), ("exit_chunk_y", "<i2"),  # -1 on classic maps
+    ("wall_color", "u1", 3), ("floor_color", "u1", 3),
+    ("agro_range", "<u2"), ("spawn_count", "<u4"), ("game_over", "u1"),
+    ("has_next_level", "u1"), ("next_level_seed", "<u8"),  # Seed of the level being prepared
+    ("rng_state", "<u4", 625), ("has_gauss", "u1"), ("gauss", "<f8"),  # Game.rng.getstate()
+]
+SAVE_PLAYER = [
+    ("x", "<u2"), ("y", "<u2"), ("hp", "<i4"), ("max_hp", "<i4"),
+    ("attack", "<i4"), ("defense", "<i4"), ("exp", "<i4"),
+    ("level", "<i4"), ("next_level", "<i4"), ("vision_radius", "<u2"),
+    ("crit_chance", "<f8"), ("crit_multiplier", "<f8"), ("gold", "<i4"),
+    ("poisoned", "u1"), ("poison_damage", "<i4"), ("poison_duration", "<i4"),
+    ("last_direction", "u1"), ("facing_right", "u1"),
+]
+SAVE_ENEMY = [
+    ("x", "<u2"), ("y", "<u2"), ("kind", "u1"), ("seq", "<u4"),
+    ("hp", "<i4"), ("max_hp", "<i4"), ("attack", "<i4"), ("defense", "<i4"), ("exp", "<i4"),
+    ("abilities", "<u2"),  # Bit i set = SPECIAL_ABILITIES[i] present
+] + [(name, "<f8") for name, _ in SPECIAL_ABILITIES]
+SAVE_ITEM = [("x", "<u2"), ("y", "<u2"), ("kind", "u1"), ("amount", "<i4")]
+
+
+
+# Replay files: a header with the map size and seed of the game, then one byte per
+# action played (see Game.play), with a checkpoint every REPLAY_CHECKPOINT_INTERVAL
+# actions: REPLAY_CHECKPOINT followed by the 8-byte Game.state_hash at that point.
+# The file also starts and ends with a checkpoint.
+REPLAY_MAGIC = b"DDRP"
+REPLAY_VERSION = 2
+REPLAY_HEADER = [
+    ("magic", "S4"), ("version", "<u2"),
+    ("width", "<u2"), ("height", "<u2"), ("seed", "<u8"),
+]
+ACTION_POISON = 9  # Actions 0-8 are moves, (dx + 1) * 3 + dy + 1
+ACTION_RESTART = 10
+REPLAY_CHECKPOINT = 0xFF
+REPLAY_CHECKPOINT_INTERVAL = 100
+
+
+
+# Headless runs: poison ticks every 1000 ms and held keys move every 100 ms,
+# so a simulated turn gets one poison tick every 10 turns
+HEADLESS_POISON_INTERVAL = 10
+
+
+
+# Display, audio and fonts are only set up when the game runs with a window
+# (see init_display, init_audio and init_fonts), so the game rules can run headless
+screen = None
+clock = None
+font_small = None
+font_medium = None
+font_large = None
+_background_init = None  # Thread loading fonts and music while the first level is generated
+_fonts_ready = threading.Event()
+
+
+
+# Times each startup phase for --startup-trace
+class StartupTrace:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = []  # (name, seconds), in the order they finished
+        self.lock = threading.Lock()  # Background phases record from another thread
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.phases.append((name, seconds))
+
+    def report(self, milestone):
+        """Print every phase and the total time from import to milestone"""
+        if not self.enabled:
+            return
+        with self.lock:
+            phases = list(self.phases)
+        print("Startup trace:")
+        for name, seconds in phases:
+            print(f"  {name:<24}{seconds * 1000:9.1f} ms")
+        total = time.perf_counter() - _IMPORT_START
+        print(f"  {'time to ' + milestone:<24}{total * 1000:9.1f} ms")
+
+
+
+# Times the phases of each Game.run frame for the F3 overlay and --perf-log. The
+# timed methods are only wrapped on the game (shadowing the class's methods) while
+# profiling is on, so a game that isn't being profiled runs exactly as before.
+class FrameProfiler:
+    # (phase, attribute of the game holding the method, "" for the game itself, method)
+    TIMED = [
+        ("move_player", "", "move_player"),  # Includes update_fov and move_enemies
+        ("update_fov", "", "update_fov"),
+        ("move_enemies", "", "move_enemies"),
+        ("draw_map", "", "draw_map"),
+        ("draw_actors", "", "draw_actors"),
+        ("draw_ui", "", "draw_ui"),
+        ("draw_minimap", "", "draw_minimap"),
+        ("flip", "presenter", "present"),
+    ]
+    PHASES = ["frame", "input"] + [phase for phase, _, _ in TIMED]
+
+    def __init__(self, window=600):
+        self.enabled = False
+        self.overlay = False  # Whether the F3 overlay is on screen
+        self.times = {phase: deque(maxlen=window) for phase in self.PHASES}  # Latest ms per phase
+        self.frame = {}  # Phase -> ms spent in it so far this frame
+        self.frame_start = None  # None while the current frame wasn't begun with timing on
+        self.frames = 0  # Frames timed so far
+        self.log = None  # --perf-log file
+        self.log_format = None  # "csv" or "json"
+        self.rows = ()  # Overlay text, refreshed every OVERLAY_REFRESH ms
+        self.rows_time = None
+
+    OVERLAY_REFRESH = 500
+
+    def start(self, game):
+        """Start timing game's frames"""
+        if self.enabled:
+            return
+        self.enabled = True
+        self.frame_start = None  # Turned on mid-frame: the first frame timed is the next one
+        for phase, owner, name in self.TIMED:
+            target = getattr(game, owner) if owner else game
+            setattr(target, name, self.timed(phase, getattr(target, name)))
+
+    def stop(self, game):
+        """Stop timing (unless a log is being written) and drop the wrappers"""
+        if not self.enabled or self.log is not None:
+            return
+        self.enabled = False
+        self.frame_start = None
+        for phase, owner, name in self.TIMED:
+            target = getattr(game, owner) if owner else game
+            delattr(target, name)
+
+    def timed(self, phase, method):
+        frame = self.frame
+        clock = time.perf_counter
+
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                frame[phase] = frame.get(phase, 0) + (clock() - start) * 1000
+        return wrapper
+
+    def toggle_overlay(self, game):
+        self.overlay = not self.overlay
+        if self.overlay:
+            self.start(game)
+        else:
+            self.stop(game)
+
+    def open_log(self, path, game):
+        """Write every frame's timings to path: CSV if it ends in .csv, else one JSON object per line"""
+        self.log = open(path, "w", newline="")
+        self.log_format = "csv" if path.lower().endswith(".csv") else "json"
+        if self.log_format == "csv":
+            self.log.write(",".join(["index", "time"] + self.PHASES) + "\n")
+        self.start(game)
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def begin_frame(self):
+        self.frame.clear()
+        self.frame_start = time.perf_counter()
+
+    def lap(self, phase):
+        """Time from the start of the frame up to now, for phases timed in Game.run itself"""
+        if self.frame_start is None:
+            return
+        self.frame[phase] = (time.perf_counter() - self.frame_start) * 1000
+
+    def end_frame(self):
+        if self.frame_start is None:
+            return
+        frame = self.frame
+        frame["frame"] = (time.perf_counter() - self.frame_start) * 1000
+        for phase, ms in frame.items():
+            self.times[phase].append(ms)
+        self.frames += 1
+        
+        if self.log is not None:
+            if self.log_format == "csv":
+                row = [str(self.frames), f"{self.frame_start:.6f}"] + [
+                    f"{frame[phase]:.3f}" if phase in frame else "" for phase in self.PHASES]
+                self.log.write(",".join(row) + "\n")
+            else:
+                record = {"index": self.frames, "time": round(self.frame_start, 6)}
+                record.update((phase, round(ms, 3)) for phase, ms in frame.items())
+                self.log.write(json.dumps(record) + "\n")
+
+    def percentiles(self, phase):
+        """(p50, p95, p99) in ms of the frames in the window that ran phase, or None"""
+        times = sorted(self.times[phase])
+        if not times:
+            return None
+        return tuple(times[min(len(times) - 1, int(len(times) * p))] for p in (0.5, 0.95, 0.99))
+
+    def overlay_rows(self, now):
+        """Overlay table, recomputed at most every OVERLAY_REFRESH ms so it doesn't force a redraw every frame"""
+        if self.rows_time is None or now - self.rows_time >= self.OVERLAY_REFRESH:
+            rows = [("ms", "p50", "p95", "p99")]
+            for phase in self.PHASES:
+                stats = self.percentiles(phase)
+                if stats:
+                    rows.append((phase,) + tuple(f"{ms:.2f}" for ms in stats))
+            self.rows = tuple(rows)
+            self.rows_time = now
+        return self.rows
+
+
+
+def held_direction(keys):
+    """Movement direction for the keys currently held down (0, 0 if none)"""
+    if keys[pygame.K_w] or keys[pygame.K_UP]:
+        return 0, -1
+    elif keys[pygame.K_s] or keys[pygame.K_DOWN]:
+        return 0, 1
+    elif keys[pygame.K_a] or keys[pygame.K_LEFT]:
+        return -1, 0
+    elif keys[pygame.K_d] or keys[pygame.K_RIGHT]:
+        return 1, 0
+    return 0, 0
+
+
+
+def init_display():
+    """Create the game window"""
+    global screen, clock
+    pygame.display.init()
+    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    pygame.display.set_caption("Dark Dungeon")
+    clock = pygame.time.Clock()
+
+
+
+def init_audio():
+    """Start the mixer and loop the background music if it's available"""
+    try:
+        pygame.mixer.init()
+        pygame.mixer.music.load("background_music.mp3")  # Place your music file in the same folder
+        pygame.mixer.music.set_volume(0.4)  # Adjust volume as needed
+        pygame.mixer.music.play(-1)  # Loop indefinitely
+    except Exception as e:
+        print(f"Could not load background music: {e}")
+
+
+
+def init_fonts():
+    global font_small, font_medium, font_large
+    pygame.font.init()
+    font_small = pygame.font.SysFont('Arial', 16)
+    font_medium = pygame.font.SysFont('Arial', 24)
+    font_large = pygame.font.SysFont('Arial', 32)
+    _fonts_ready.set()
+
+
+
+def start_background_init(trace):
+    """Load fonts (fontconfig scan) and music on a worker thread"""
+    global _background_init
+    
+    def load():
+        try:
+            with trace.phase("fonts (background)"):
+                init_fonts()
+        finally:
+            _fonts_ready.set()  # Never leave the main thread waiting
+        with trace.phase("music (background)"):
+            init_audio()
+    
+    _background_init = threading.Thread(target=load, name="background-init", daemon=True)
+    _background_init.start()
+
+
+
+def ensure_fonts():
+    """Make sure the fonts exist before anything is rendered"""
+    if _background_init is not None:
+        _fonts_ready.wait()
+    if font_small is None:
+        init_fonts()
+
+
 
 
-# Fonts
-font_small = pygame.font.SysFont('Arial', 16)
-font_medium = pygame.font.SysFont('Arial', 24)
-font_large = pygame.font.SysFont('Arial', 32)
 
+# LRU cache of rendered text surfaces keyed by (text, font, colour), so HUD text
+# is only re-rendered when the value it shows changes
+class TextCache:
+    def __init__(self, max_entries=256):
+        self.entries = OrderedDict()  # (text, font, color) -> surface, least recently used first
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, font, text, color):
+        """Same as font.render(text, True, color), but reuses earlier surfaces"""
+        key = (text, font, color)
+        surface = self.entries.get(key)
+        if surface is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return surface
+        
+        self.misses += 1
+        surface = font.render(text, True, color)
+        self.entries[key] = surface
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return surface
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "cached": len(self.entries)}
+
+
+text_cache = TextCache()
+
+
+
+_panels = {}  # (size, color) -> filled surface
+
+def translucent_panel(size, color):
+    """Return a surface filled with an RGBA colour, created once and then reused"""
+    panel = _panels.get((size, color))
+    if panel is None:
+        panel = pygame.Surface(size, pygame.SRCALPHA)
+        panel.fill(color)
+        _panels[(size, color)] = panel
+    return panel
 
 
 
 
 def load_base64_image(base64_string, size=(GRID_SIZE, GRID_SIZE)):
     """Convert to BMP to avoid libpng warnings."""
+    from PIL import Image  # Only needed once a sprite is actually decoded
+    
     image_data = base64.b64decode(base64_string)
     
     # Load with Pillow, convert to BMP (no libpng involved)
@@ -187,20 +647,230 @@ def load_base64_image(base64_string, size=(GRID_SIZE, GRID_SIZE)):
 
 
 
+# Map sprite names to their base64 images
+SPRITE_IMAGES = {
+    "Player": PLAYER_IMAGE,
+    "goblin": GOBLIN_IMAGE,
+    "orc": ORC_IMAGE,
+    "skeleton": SKELETON_IMAGE,
+    "zombie": ZOMBIE_IMAGE,
+    "troll": TROLL_IMAGE,
+    "ghost": GHOST_IMAGE,
+    "Health Potion": HEALTH_POTION_IMAGE,
+    "Weapon": WEAPON_IMAGE,
+    "Armor": ARMOR_IMAGE,
+    "Treasure": TREASURE_IMAGE,
+    "Gold": GOLD_IMAGE,
+    "Exit": EXIT_IMAGE
+}
+
+
+
+# Process-wide sprite registry: each image is decoded once and the
+# resulting surface is shared by every entity that uses it
+class SpriteCache:
+    def __init__(self, images):
+        self.images = images  # Sprite name -> base64 image
+        self.surfaces = {}  # (name, flipped, size) -> decoded surface
+        self.hits = 0  # Lookups served from the cache
+        self.misses = 0  # Lookups that had to decode (or flip) an image
+        self.enabled = True  # Headless runs turn this off so entities get no sprites
+
+    def __contains__(self, name):
+        return name in self.images
+
+    def get(self, name, flipped=False, size=(GRID_SIZE, GRID_SIZE)):
+        """Return the shared surface for a sprite, decoding it on first use
+
+        Returns None if sprites are off or the image can't be decoded (e.g. Pillow isn't
+        installed), and callers draw the entity's character instead.
+        """
+        if not self.enabled:
+            return None
+        key = (name, flipped, size)
+        if key in self.surfaces:
+            self.hits += 1
+            return self.surfaces[key]
+
+        self.misses += 1
+        if flipped:
+            # Flipped variants are derived from the cached upright sprite
+            upright = self.get(name, False, size)
+            sprite = None if upright is None else pygame.transform.flip(upright, True, False)
+        else:
+            try:
+                sprite = load_base64_image(self.images[name], size)
+                # Match the display format once so blits don't convert every frame
+                if pygame.display.get_surface() is not None:
+                    sprite = sprite.convert_alpha()
+            except Exception as e:
+                # Remembered, so a broken sprite is reported once rather than every frame
+                print(f"Failed to load sprite {name}: {e}")
+                sprite = None
+        self.surfaces[key] = sprite
+        return sprite
+
+    def stats(self):
+        """Return cache counters (useful to check that nothing is decoded after warm-up)"""
+        return {"hits": self.hits, "misses": self.misses, "cached": len(self.surfaces)}
+
+    def clear(self):
+        self.surfaces.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+sprite_cache = SpriteCache(SPRITE_IMAGES)
 
 
 
 
 
 
-# A single tile on the game map
+
+
+
+
+# A single tile on the game map (a lightweight view into the TileMap arrays)
 class Tile:
-    def __init__(self, x, y, tile_type):
+    __slots__ = ("tiles", "x", "y")
+
+    def __init__(self, tiles, x, y):
+        self.tiles = tiles  # TileMap holding the actual data
         self.x = x  # X-coordinate of the tile
         self.y = y  # Y-coordinate of the tile
-        self.type = tile_type  # Type of tile: 0 = wall, 1 = floor, 2 = door
-        self.explored = False  # Whether the player has ever seen this tile
-        self.visible = False   # Whether the tile is currently in the player's field of view
+
+    @property
+    def type(self):
+        # Type of tile: 0 = wall, 1 = floor, 2 = door
+        return int(self.tiles.type[self.y, self.x])
+
+    @type.setter
+    def type(self, tile_type):
+        self.tiles.set_type(self.x, self.y, tile_type)
+
+    @property
+    def explored(self):
+        # Whether the player has ever seen this tile
+        return self.tiles.is_explored(self.x, self.y)
+
+    @explored.setter
+    def explored(self, value):
+        self.tiles.set_explored(self.x, self.y, value)
+
+    @property
+    def visible(self):
+        # Whether the tile is currently in the player's field of view
+        return bool(self.tiles.visible[self.y, self.x])
+
+    @visible.setter
+    def visible(self, value):
+        self.tiles.visible[self.y, self.x] = value
+
+
+
+# One row of the map, so that tiles[y][x] keeps working
+class TileRow:
+    __slots__ = ("tiles", "y")
+
+    def __init__(self, tiles, y):
+        self.tiles = tiles
+        self.y = y
+
+    def __getitem__(self, x):
+        return Tile(self.tiles, x, self.y)
+
+    def __iter__(self):
+        return (Tile(self.tiles, x, self.y) for x in range(self.tiles.width))
+
+    def __len__(self):
+        return self.tiles.width
+
+
+
+# The whole dungeon map stored as struct-of-arrays, indexed [y, x]. The map is
+# split into CHUNK x CHUNK chunks: explored flags are kept as one bitset per
+# chunk, and on large maps chunks are only generated when the player gets close.
+class TileMap:
+    CHUNK = 40  # Side of a chunk in tiles (a multiple of 8, so chunk rows pack into whole bytes)
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.chunks_x = -(-width // self.CHUNK)
+        self.chunks_y = -(-height // self.CHUNK)
+        self.type = np.zeros((height, width), dtype=np.uint8)  # 0 = wall, 1 = floor, 2 = exit
+        self.visible = np.zeros((height, width), dtype=bool)  # Currently in the field of view
+        # Ever seen by the player, one bit per tile: [chunk y, chunk x, row, byte]
+        self.explored_bits = np.zeros((self.chunks_y, self.chunks_x, self.CHUNK, self.CHUNK // 8), dtype=np.uint8)
+        self.generated = np.zeros((self.chunks_y, self.chunks_x), dtype=bool)  # Chunks laid out so far
+        self.version = 0  # Bumped whenever a tile type (and so its opacity) may have changed
+
+    def __getitem__(self, y):
+        return TileRow(self, y)
+
+    def __iter__(self):
+        return (TileRow(self, y) for y in range(self.height))
+
+    def __len__(self):
+        return self.height
+
+    def reset(self):
+        """Turn the whole map back into unexplored walls"""
+        self.type.fill(0)
+        self.visible.fill(False)
+        self.explored_bits.fill(0)
+        self.generated.fill(False)
+        self.version += 1
+
+    def load(self, types):
+        """Replace the map with the given tile types, all unexplored"""
+        self.reset()
+        self.type[:] = types
+
+    def clear_visible(self):
+        self.visible.fill(False)
+
+    def carve(self, x1, y1, x2, y2, tile_type=1):
+        """Set every tile in the half-open rectangle [x1, x2) x [y1, y2) to tile_type"""
+        self.type[y1:y2, x1:x2] = tile_type
+        self.version += 1
+
+    def set_type(self, x, y, tile_type):
+        self.type[y, x] = tile_type
+        self.version += 1
+
+    def is_explored(self, x, y):
+        c = self.CHUNK
+        return bool(self.explored_bits[y // c, x // c, y % c, x % c // 8] & (0x80 >> x % 8))
+
+    def set_explored(self, x, y, value=True):
+        c = self.CHUNK
+        index = (y // c, x // c, y % c, x % c // 8)
+        if value:
+            self.explored_bits[index] |= 0x80 >> x % 8
+        else:
+            self.explored_bits[index] &= ~(0x80 >> x % 8) & 0xFF
+
+    def mark_explored(self, cells):
+        """Set the explored bit of every tile in cells (array of flat indices y * width + x)"""
+        c = self.CHUNK
+        y, x = np.divmod(cells, self.width)
+        bits = (0x80 >> (x % 8)).astype(np.uint8)
+        np.bitwise_or.at(self.explored_bits, (y // c, x // c, y % c, x % c // 8), bits)
+
+    def explored_region(self, x1, y1, x2, y2):
+        """Explored flags of the half-open rectangle [x1, x2) x [y1, y2) as a bool array [y, x]"""
+        c = self.CHUNK
+        cx1, cy1 = x1 // c, y1 // c
+        cx2, cy2 = (x2 - 1) // c + 1, (y2 - 1) // c + 1
+        # Unpack only the chunks overlapping the rectangle and lay them out as rows
+        bits = np.unpackbits(self.explored_bits[cy1:cy2, cx1:cx2], axis=-1)
+        rows = bits.transpose(0, 2, 1, 3).reshape((cy2 - cy1) * c, (cx2 - cx1) * c)
+        return rows[y1 - cy1 * c:y2 - cy1 * c, x1 - cx1 * c:x2 - cx1 * c].view(bool)
+
+    def explored_count(self):
+        return int(np.count_nonzero(np.unpackbits(self.explored_bits)))
 
 
 
@@ -229,58 +899,81 @@ class Room:
 
 
 
-# Represents any character or object in the game world (player, enemies, items)
-class Entity:
-    def __init__(self, x, y, char, color, name, hp=1, attack=0, defense=0, exp=0):
-        self.x = x  # X-coordinate on the map
-        self.y = y  # Y-coordinate on the map
-        self.char = char  # ASCII character used to represent the entity (fallback for no sprite)
-        self.color = color  # Color used for fallback drawing
-        self.name = name  # Name of the entity (used for identifying type)
-        self.max_hp = hp  # Maximum health
-        self.hp = hp  # Current health
-        self.attack = attack  # Attack value (damage output)
-        self.defense = defense  # Defense value (damage reduction)
-        self.exp = exp  # Experience points awarded for killing this entity
-        self.alive = True  # Whether the entity is currently alive
-        self.sprite = None  # Placeholder for loaded image/sprite
-        self.show_health = False  # Track if health bar should be shown
-        self.health_bar_time = 0  # Track when to hide health bar
+ARCHETYPES = []  # Every Archetype, indexed by Archetype.id
+_archetype_lock = threading.Lock()  # Levels are also built on a worker thread
 
-        # Attempt to load a sprite based on the entity's name
-        self.load_sprite()
 
-    def load_sprite(self):
-        """Load graphical sprite based on entity type"""
-        try:
-            # Map entity names to their sprite images
-            sprite_mapping = {
-                "Player": PLAYER_IMAGE,
-                "goblin": GOBLIN_IMAGE,
-                "orc": ORC_IMAGE,
-                "skeleton": SKELETON_IMAGE,
-                "zombie": ZOMBIE_IMAGE,
-                "troll": TROLL_IMAGE,
-                "ghost": GHOST_IMAGE,
-                "Health Potion": HEALTH_POTION_IMAGE,
-                "Weapon": WEAPON_IMAGE,
-                "Armor": ARMOR_IMAGE,
-                "Treasure": TREASURE_IMAGE,
-                "Gold": GOLD_IMAGE
-            }
-            
-            if self.name in sprite_mapping:
-                self.sprite = load_base64_image(sprite_mapping[self.name])
-        except Exception as e:
-            # Fallback to simple colored circle if sprite loading fails
-            self.sprite = pygame.Surface((GRID_SIZE, GRID_SIZE))
-            self.sprite.fill(BLACK)
-            pygame.draw.circle(
-                self.sprite, 
-                self.color, 
-                (GRID_SIZE//2, GRID_SIZE//2), 
-                GRID_SIZE//2 - 2
-            )
+
+# Abilities of an enemy (see SPECIAL_ABILITIES), compiled from its special dict into
+# flags and parameters so that combat doesn't look anything up per swing. Enemies
+# of one kind on one dungeon level share an Archetype (see enemy_archetype).
+class Archetype:
+    __slots__ = ("id", "special", "stats", "accuracy_bonus", "armor_pen",
+                 "crits", "crit_chance", "crit_multiplier",
+                 "dodges", "dodge_chance", "double_attacks", "double_attack_chance",
+                 "poisons", "poison_chance", "poison_damage", "poison_duration",
+                 "regenerates", "regen_amount", "drains", "life_drain")
+
+    def __init__(self, special, stats=()):
+        self.special = special  # Ability name -> value, as saved
+        self.stats = stats  # (low, high, offset) for the hp, attack, defense and exp rolls
+        self.accuracy_bonus = special.get("accuracy_bonus", 0)
+        self.armor_pen = special.get("armor_pen", 0)
+        self.crits = "crit_chance" in special
+        self.crit_chance = special.get("crit_chance", 0)
+        self.crit_multiplier = special.get("crit_multiplier", 1)
+        self.dodges = "dodge_chance" in special
+        self.dodge_chance = special.get("dodge_chance", 0)
+        self.double_attacks = "double_attack_chance" in special
+        self.double_attack_chance = special.get("double_attack_chance", 0)
+        self.poisons = "poison_chance" in special
+        self.poison_chance = special.get("poison_chance", 0)
+        self.poison_damage = special.get("poison_damage", 1)
+        self.poison_duration = special.get("poison_duration", 2)
+        self.regenerates = "regeneration" in special
+        self.regen_amount = special.get("regen_amount", 1)
+        self.drains = "life_drain" in special
+        self.life_drain = special.get("life_drain", 0)
+        with _archetype_lock:
+            self.id = len(ARCHETYPES)  # What the enemy store keeps
+            ARCHETYPES.append(self)
+
+
+# The player, items and enemies without special abilities
+NO_ABILITIES = Archetype({})
+
+_archetypes = {}  # (enemy type, dungeon level) -> Archetype
+
+
+
+def enemy_special(enemy_type, dungeon_level):
+    """Special abilities of an enemy kind (index into ENEMY_TYPES) at a dungeon level"""
+    special = dict(ENEMY_SPECIALS[enemy_type])
+    if "regen_amount" in special:
+        special["regen_amount"] += dungeon_level
+    return special
+
+
+
+def enemy_archetype(enemy_type, dungeon_level):
+    """The Archetype of an enemy kind at a dungeon level, compiled on first use"""
+    key = (enemy_type, dungeon_level)
+    archetype = _archetypes.get(key)
+    if archetype is None:
+        stats = tuple((low, high, per_level * (dungeon_level - 1))
+                      for low, high, per_level in ENEMY_STATS[enemy_type])
+        archetype = _archetypes[key] = Archetype(enemy_special(enemy_type, dungeon_level), stats)
+    return archetype
+
+
+
+
+
+
+# Drawing shared by the player and the enemy handles. Needs sprite, char, color,
+# name, hp, max_hp, alive and health_bar_time.
+class Drawable:
+    __slots__ = ()
 
     def draw_health_bar(self, surface, x, y, width, height):
         """Draw a health bar above the entity"""
@@ -307,18 +1000,47 @@ class Entity:
             surface.blit(self.sprite, (x, y))
         else:
             # Fallback to character representation
-            text = font_medium.render(self.char, True, self.color)
+            text = text_cache.render(font_medium, self.char, self.color)
             surface.blit(text, (x, y))
         
         # Draw health bar if needed (for enemies only)
-        if (self.name != "Player" and self.alive and 
-            (self.show_health or pygame.time.get_ticks() - self.health_bar_time < 2000)):
+        if self.health_bar_shown(pygame.time.get_ticks()):
             self.draw_health_bar(surface, x, y, size, size)
-            self.show_health = False  # Reset after drawing
 
+    def health_bar_shown(self, now):
+        """Whether the health bar is on screen at time now (enemies only, for a while after health_bar_time)"""
+        return (self.name != "Player" and self.alive and
+                now - self.health_bar_time < HEALTH_BAR_DURATION)
 
 
 
+# Represents the player in the game world (enemies and items live in an ActorStore)
+class Entity(Drawable):
+    def __init__(self, x, y, char, color, name, hp=1, attack=0, defense=0, exp=0):
+        self.x = x  # X-coordinate on the map
+        self.y = y  # Y-coordinate on the map
+        self.char = char  # ASCII character used to represent the entity (fallback for no sprite)
+        self.color = color  # Color used for fallback drawing
+        self.name = name  # Name of the entity (used for identifying type)
+        self.max_hp = hp  # Maximum health
+        self.hp = hp  # Current health
+        self.attack = attack  # Attack value (damage output)
+        self.defense = defense  # Defense value (damage reduction)
+        self.exp = exp  # Experience points awarded for killing this entity
+        self.alive = True  # Whether the entity is currently alive
+        self.sprite = None  # Placeholder for loaded image/sprite
+        self.health_bar_time = 0  # When the health bar was last shown, see health_bar_shown
+        self.archetype = NO_ABILITIES  # Special abilities, see Archetype
+
+        # Attempt to load a sprite based on the entity's name
+        self.load_sprite()
+
+    def load_sprite(self):
+        """Load graphical sprite based on entity type (None draws the character instead)"""
+        # Sprites are shared through the process-wide cache
+        if self.name in sprite_cache:
+            self.sprite = sprite_cache.get(self.name)
+
 
 
 # Represents the player character in the game, inheriting from Entity
@@ -337,6 +1059,7 @@ class Player(Entity):
         self.poison_damage = 0
         self.poison_duration = 0
         self.last_direction = "left"  # Default to facing right
+        self.facing_right = True  # Which way the sprite faces, kept apart from the sprite itself
         self.left_sprite = None
         self.right_sprite = None
         self.load_sprites()  # Load both sprites
@@ -349,32 +1072,325 @@ class Player(Entity):
         self.defense += 2 + self.level // 3 
         self.next_level += 100 * self.level
         self.crit_chance = min(0.3, self.crit_chance + 0.02)
+
+    def load_sprites(self):
+        """Load both left and right facing sprites (None draws the character instead)"""
+        self.left_sprite = sprite_cache.get("Player")  # Original is left-facing
+        self.right_sprite = sprite_cache.get("Player", flipped=True)  # Flip to face right
+        
+        # Set initial sprite (default to right)
+        self.face(self.facing_right)
+
+    def face(self, right):
+        """Turn the player right or left and show the matching sprite"""
+        self.facing_right = right
+        self.sprite = self.right_sprite if right else self.left_sprite
+
+
+
+
+
+
+def store_column(name):
+    """Property reading and writing one ActorStore column at the handle's slot"""
+    get_column = operator.attrgetter(name)
+    
+    def get(actor):
+        return get_column(actor.store)[actor.slot]
+    
+    def set(actor, value):
+        get_column(actor.store)[actor.slot] = value
+    
+    return property(get, set)
+
+
+
+# The enemies or the items of a level, kept as one typed array per field (the
+# handle class's FIELDS) instead of one object each. Actors are addressed by
+# handles, which follow them when removing another actor moves them to a new slot.
+class ActorStore:
+    def __init__(self, handle_class):
+        self.handle_class = handle_class
+        self.names = [name for name, _ in handle_class.FIELDS]
+        self.columns = []
+        for name, typecode in handle_class.FIELDS:
+            setattr(self, name, array(typecode))
+            self.columns.append(getattr(self, name))
+        self.handles = []  # Handle of the actor in each slot
+
+    def __len__(self):
+        return len(self.handles)
+
+    def __iter__(self):
+        return iter(self.handles)
+
+    def add(self, *values):
+        """Append an actor with a value for each field, in FIELDS order; returns its handle"""
+        for column, value in zip(self.columns, values):
+            column.append(value)
+        handle = self.handle_class(self, len(self.handles))
+        self.handles.append(handle)
+        return handle
+
+    def remove(self, handle):
+        """Move the last actor into the removed one's slot, so removing is O(1) whatever the order"""
+        slot = handle.slot
+        for column in self.columns:
+            value = column.pop()
+            if slot < len(column):
+                column[slot] = value
+        moved = self.handles.pop()
+        if moved is not handle:
+            self.handles[slot] = moved
+            moved.slot = slot
+        handle.slot = None
+
+    def column(self, name):
+        """Copy of a whole column as a NumPy array, for passes over every actor"""
+        return np.array(getattr(self, name))
+
+    def clear(self):
+        for column in self.columns:
+            del column[:]
+        for handle in self.handles:
+            handle.slot = None
+        self.handles = []
+
+
+
+# Handle to an enemy in an ActorStore
+class Enemy(Drawable):
+    __slots__ = ("store", "slot")
+    FIELDS = [
+        ("x", "i"), ("y", "i"), ("kind", "B"),  # Kind is the index into ENEMY_TYPES
+        ("hp", "i"), ("max_hp", "i"), ("attack", "i"), ("defense", "i"), ("exp", "i"),
+        ("archetype_id", "H"),  # Index into ARCHETYPES
+        ("seq", "I"),  # Spawn order on the level, set by Game.add_entity
+        ("health_bar_time", "q"),  # See Drawable.health_bar_shown
+    ]
+
+    def __init__(self, store, slot):
+        self.store = store
+        self.slot = slot  # None once the enemy has been removed
+
+    x = store_column("x")
+    y = store_column("y")
+    kind = store_column("kind")
+    hp = store_column("hp")
+    max_hp = store_column("max_hp")
+    attack = store_column("attack")
+    defense = store_column("defense")
+    exp = store_column("exp")
+    seq = store_column("seq")
+    health_bar_time = store_column("health_bar_time")
+
+    @property
+    def alive(self):
+        return self.slot is not None
+
+    @property
+    def archetype(self):
+        return ARCHETYPES[self.store.archetype_id[self.slot]]
+
+    @property
+    def name(self):
+        return ENEMY_TYPES[self.store.kind[self.slot]]
+
+    @property
+    def char(self):
+        return ENEMY_CHARS[self.store.kind[self.slot]]
+
+    @property
+    def color(self):
+        return ENEMY_COLORS[self.store.kind[self.slot]]
+
+    @property
+    def sprite(self):
+        return sprite_cache.get(self.name)
+
+
+
+# Handle to an item in an ActorStore
+class Item:
+    __slots__ = ("store", "slot")
+    FIELDS = [("x", "i"), ("y", "i"), ("kind", "B"), ("amount", "i")]  # Kind is the index into ITEM_KINDS
+
+    def __init__(self, store, slot):
+        self.store = store
+        self.slot = slot  # None once the item has been picked up
+
+    x = store_column("x")
+    y = store_column("y")
+    kind = store_column("kind")
+    amount = store_column("amount")
+
+    @property
+    def char(self):
+        return ITEM_KINDS[self.store.kind[self.slot]][0]
+
+    @property
+    def color(self):
+        return ITEM_KINDS[self.store.kind[self.slot]][1]
+
+    @property
+    def name(self):
+        return ITEM_KINDS[self.store.kind[self.slot]][2]
+
+    @property
+    def effect(self):
+        return ITEM_KINDS[self.store.kind[self.slot]][3]
+
+    def draw(self, surface, x, y, size):
+        """Render the item on screen at specified pixel coordinates"""
+        char, color, name, _ = ITEM_KINDS[self.store.kind[self.slot]]
+        sprite = sprite_cache.get(name)
+        if sprite:
+            surface.blit(sprite, (x, y))
+        else:
+            surface.blit(text_cache.render(font_medium, char, color), (x, y))
+
+
+
+
+
+
+# Pre-rendered map at one pixel per tile. Only tiles whose visible/explored
+# state changed get repainted, and the viewport is drawn by scaling the
+# on-screen part of the layer up to GRID_SIZE and blitting it once.
+class MapLayer:
+    UNEXPLORED = (0, 0, 0, 255)  # Colour of tiles the player hasn't seen
+
+    def __init__(self, width, height, alpha=False):
+        self.width = width
+        self.height = height
+        self.alpha = alpha  # Whether the palette's alpha channel is used
+        self.surface = pygame.Surface((width, height), pygame.SRCALPHA if alpha else 0)
+        self.state = np.full((height, width), -1, dtype=np.int16)  # State each pixel was last painted with
+        self.palette = np.zeros((12, 4), dtype=np.uint8)  # RGBA colour for each state (see tile_states)
+        self.dirty = []  # Map rectangles (x1, y1, x2, y2) that may have changed
+        self.view = None  # Scaled copy of the viewport, reused while nothing changes
+        self.view_key = None  # (area, version) the scaled view was built from
+        self.version = 0  # Bumped whenever a pixel of the layer changes
+
+    @staticmethod
+    def tile_states(tiles, x1, y1, x2, y2):
+        """Encode type, visible and explored of a map region as one small integer per tile"""
+        region = (slice(y1, y2), slice(x1, x2))
+        return (tiles.type[region].astype(np.int16) * 4 +
+                tiles.visible[region] * 2 +
+                tiles.explored_region(x1, y1, x2, y2))
+
+    def set_colors(self, wall_color, floor_color):
+        """Rebuild the palette for a new level and repaint everything on the next refresh"""
+        dark_wall = tuple(c // 2 for c in wall_color) + (255,)
+        dark_floor = tuple(c // 2 for c in floor_color) + (255,)
+        self.palette[:] = BLACK + (255,)  # The exit gets its sprite drawn on top
+        self.palette[0 * 4] = self.palette[1 * 4] = self.palette[2 * 4] = self.UNEXPLORED
+        self.palette[0 * 4 + 1] = dark_wall  # Explored wall
+        self.palette[1 * 4 + 1] = dark_floor  # Explored floor
+        self.palette[2 * 4 + 1] = dark_floor  # Explored exit
+        for explored in (0, 1):
+            self.palette[0 * 4 + 2 + explored] = wall_color + (255,)  # Visible wall
+            self.palette[1 * 4 + 2 + explored] = floor_color + (255,)  # Visible floor
+        self.invalidate_all()
+
+    def invalidate(self, x1, y1, x2, y2):
+        """Mark a map rectangle for repainting"""
+        x1, y1 = max(0, x1), max(0, y1)
+        x2, y2 = min(self.width, x2), min(self.height, y2)
+        if x1 < x2 and y1 < y2:
+            self.dirty.append((x1, y1, x2, y2))
+            # Don't let the list grow while nothing is being drawn
+            if len(self.dirty) > 64:
+                self.invalidate_all()
+
+    def invalidate_all(self):
+        self.state.fill(-1)
+        self.version += 1
+        self.dirty = [(0, 0, self.width, self.height)]
+
+    def clear(self):
+        """Paint every tile unexplored, as they all are on a freshly reset TileMap"""
+        # Cheaper than repainting the whole map from the tile states on big maps
+        self.surface.fill(self.UNEXPLORED)
+        self.state.fill(-1)
+        self.version += 1
+        self.dirty = []
+
+    def refresh(self, tiles):
+        """Repaint the tiles in the dirty rectangles whose state changed"""
+        if not self.dirty:
+            return
+        pixels = pygame.surfarray.pixels3d(self.surface)  # Indexed [x, y]
+        alpha = pygame.surfarray.pixels_alpha(self.surface) if self.alpha else None
+        for x1, y1, x2, y2 in self.dirty:
+            states = self.tile_states(tiles, x1, y1, x2, y2)
+            changed = states != self.state[y1:y2, x1:x2]
+            if changed.any():
+                colors = self.palette[states.T[changed.T]]
+                pixels[x1:x2, y1:y2][changed.T] = colors[:, :3]
+                if alpha is not None:
+                    alpha[x1:x2, y1:y2][changed.T] = colors[:, 3]
+                self.state[y1:y2, x1:x2][changed] = states[changed]
+                self.version += 1
+        del pixels, alpha  # Unlock the surface
+        self.dirty = []
+
+    def draw(self, surface, camera_x, camera_y, start_x, start_y, end_x, end_y):
+        """Scale the tiles in [start, end) up to screen size and blit them in one call"""
+        area = pygame.Rect(start_x, start_y, end_x - start_x, end_y - start_y)
+        size = (area.w * GRID_SIZE, area.h * GRID_SIZE)
+        if self.view is None or self.view.get_size() != size:
+            self.view = pygame.Surface(size, 0, self.surface)
+            self.view_key = None
+        key = (tuple(area), self.version)
+        if key != self.view_key:
+            pygame.transform.scale(self.surface.subsurface(area), size, self.view)
+            self.view_key = key
+        surface.blit(self.view, (start_x * GRID_SIZE - camera_x, start_y * GRID_SIZE - camera_y))
+
+
+
+# Minimap version of the map layer: semi-transparent where unexplored, with the
+# exit shown in black. The finished panel is only rebuilt when the cropped area,
+# the player or the layer changes.
+class Minimap(MapLayer):
+    UNEXPLORED = (0, 0, 0, 150)  # Semi-transparent black background
+
+    def __init__(self, width, height):
+        super().__init__(width, height, alpha=True)
+        self.panel = pygame.Surface((MINIMAP_WIDTH, MINIMAP_HEIGHT), pygame.SRCALPHA)
+        self.panel_key = None
+
+    def set_colors(self, wall_color, floor_color):
+        super().set_colors(wall_color, floor_color)
+        self.palette[2 * 4 + 1] = BLACK + (255,)  # Explored exit
+
+    def render(self, start_x, start_y, end_x, end_y, player_x, player_y):
+        """Return the minimap panel for the map area [start, end) around the player"""
+        key = (start_x, start_y, end_x, end_y, player_x, player_y, self.version)
+        if key == self.panel_key:
+            return self.panel
+        self.panel_key = key
+        
+        self.panel.fill(self.UNEXPLORED)
+        
+        # Scale the cropped tiles up in one go
+        area = pygame.Rect(start_x, start_y, end_x - start_x, end_y - start_y)
+        if area.w > 0 and area.h > 0:
+            size = (area.w * MINIMAP_CELL_SIZE, area.h * MINIMAP_CELL_SIZE)
+            pygame.transform.scale(self.surface.subsurface(area), size, self.panel.subsurface((0, 0) + size))
         
-        # Increase agro range in the game by 0.5 per level (rounded up)
-        game.enemy_agro_range = math.ceil(self.level * 0.5)
+        # Draw player position
+        player_map_x = (player_x - start_x) * MINIMAP_CELL_SIZE
+        player_map_y = (player_y - start_y) * MINIMAP_CELL_SIZE
+        pygame.draw.rect(self.panel, GREEN, 
+                        (player_map_x, player_map_y, MINIMAP_CELL_SIZE, MINIMAP_CELL_SIZE))
         
-        return f"Level up! You are now level {self.level}! Enemies notice you from farther away!"
+        # Draw a border around the minimap
+        pygame.draw.rect(self.panel, WHITE, (0, 0, MINIMAP_WIDTH, MINIMAP_HEIGHT), 1)
+        return self.panel
 
-    def load_sprites(self):
-        """Load both left and right facing sprites"""
-        try:
-            # Load the base player image (let's assume it faces right by default)
-            base_sprite = load_base64_image(PLAYER_IMAGE)
-            
-            # If original sprite faces left:
-            self.left_sprite = base_sprite  # Original is left-facing
-            self.right_sprite = pygame.transform.flip(base_sprite, True, False)  # Flip to face right
-            
-            # Set initial sprite (default to right)
-            self.sprite = self.right_sprite
-        except Exception as e:
-            print(f"Error loading player sprites: {e}")
-            # Fallback to simple colored circle
-            self.sprite = pygame.Surface((GRID_SIZE, GRID_SIZE))
-            self.sprite.fill(BLACK)
-            pygame.draw.circle(self.sprite, self.color, (GRID_SIZE//2, GRID_SIZE//2), GRID_SIZE//2 - 2)
-            self.left_sprite = self.sprite
-            self.right_sprite = self.sprite
 
 
 
@@ -384,56 +1400,230 @@ class Player(Entity):
 
 
 
+# Tracks which screen regions changed since the last presented frame. Each
+# region is described by a key (the values it shows); only regions whose key
+# changed are redrawn and passed to display.update, and when no key changed
+# the frame is skipped altogether.
+class Presenter:
+    def __init__(self):
+        self.keys = {}  # Region name -> key it was last presented with
+        self.rects = []  # Screen rectangles to present
+
+    def check(self, name, key, rect):
+        """Mark rect dirty if the region's key changed; returns whether it did"""
+        if name in self.keys and self.keys[name] == key:
+            return False
+        self.keys[name] = key
+        self.rects.append(rect)
+        return True
+
+    def forget(self, keep):
+        """Drop every region whose name isn't in keep (e.g. after a full redraw)"""
+        self.keys = {name: key for name, key in self.keys.items() if name in keep}
+
+    def invalidate_all(self):
+        """Present the whole screen next frame (e.g. after the window was exposed)"""
+        self.keys.clear()
+
+    def present(self):
+        if self.rects:
+            pygame.display.update(self.rects)
+            self.rects = []
+
+
+
+
+
+
+# Fixed-size ring of the latest game events (see EVENT_TEXT). Recording an event
+# only stores a tuple; text is formatted when the message or the log is drawn.
+class EventLog:
+    def __init__(self, size):
+        self.size = size
+        self.entries = [None] * size  # Latest events with a log line, at count % size
+        self.count = 0  # Events ever written to entries
+        self.floor = 0  # count when the current level started; older lines aren't shown
+        self.last = None  # Latest event of any kind, shown as the message
+        self.last_time = 0  # Ticks when last was recorded
+        self.now = 0  # Ticks of the current turn, set by the game loop
+
+    def record(self, kind, actor=None, target=None, amount=0, extra=0):
+        event = (kind, actor, target, amount, extra)
+        self.last = event
+        self.last_time = self.now
+        if EVENT_TEXT[kind][1] is not None:
+            self.entries[self.count % self.size] = event
+            self.count += 1
+
+    def new_level(self):
+        """Hide the log lines recorded so far; the message stays"""
+        self.floor = self.count
+
+    def clear(self):
+        self.entries = [None] * self.size
+        self.count = 0
+        self.floor = 0
+        self.last = None
+        self.last_time = 0
+
+    def message(self, now):
+        """Text of the latest event, or None once it has been on screen for MESSAGE_DURATION"""
+        if self.last is None or now - self.last_time >= MESSAGE_DURATION:
+            return None
+        return self.format(self.last, 0)
+
+    def lines(self):
+        """Log lines of the current level, oldest first"""
+        first = max(self.floor, self.count - self.size)
+        return [self.format(self.entries[i % self.size], 1) for i in range(first, self.count)]
+
+    @staticmethod
+    def format(event, which):
+        kind, actor, target, amount, extra = event
+        return EVENT_TEXT[kind][which].format(actor=actor, target=target, amount=amount, extra=extra)
+
+
+
+
+
+
+def distance_map(walkable, x, y):
+    """Steps from (x, y) to every cell of a boolean walkable grid (4-connected), -1 where unreachable"""
+    # Breadth-first search one whole wavefront at a time
+    height, width = walkable.shape
+    open_cells = np.zeros((height + 2, width + 2), dtype=bool)  # One cell of wall all around
+    open_cells[1:-1, 1:-1] = walkable
+    open_cells[y + 1, x + 1] = False
+    frontier = np.zeros_like(open_cells)
+    frontier[y + 1, x + 1] = True
+    grown = np.zeros_like(open_cells)
+    inner = grown[1:-1, 1:-1]
+    distances = np.full((height + 2, width + 2), -1, dtype=np.int32)
+    distances[y + 1, x + 1] = 0
+    step = 0
+    while True:
+        np.logical_or(frontier[:-2, 1:-1], frontier[2:, 1:-1], out=inner)
+        inner |= frontier[1:-1, :-2]
+        inner |= frontier[1:-1, 2:]
+        np.logical_and(grown, open_cells, out=frontier)
+        if not frontier.any():
+            return distances[1:-1, 1:-1]
+        step += 1
+        open_cells ^= frontier
+        distances[frontier] = step
+
+
+
+# Spatial index mapping each (x, y) cell to the actor standing on it
+class SpatialIndex:
+    BUCKET = 8  # Side of the coarse buckets, in tiles
 
-class Game:
-    
-    # Represents the main game state
     def __init__(self):
-        self.map_width = 100
-        self.map_height = 100
-        self.tiles = [[Tile(x, y, 0) for x in range(self.map_width)] for y in range(self.map_height)]
-        self.player = Player(0, 0)  # Initialize player with dummy position
-        self.entities = []
-        self.items = []
-        self.exit_pos = (0, 0)
-        self.message = ""
-        self.message_time = 0
-        self.camera_x = 0
-        self.camera_y = 0
-        self.game_state = "playing"
-        self.dungeon_level = 1
-        self.combat_log = []
-        self.max_log_entries = 10
-        self.wall_color = STONE  # Default
-        self.floor_color = DARK_GRAY  # Default
-        self.enemy_agro_range = 1  # Base agro range
-        self.generate_dungeon()
-    
-    
-    
+        self.cells = {}  # (x, y) -> actor
+        self.buckets = {}  # (x // BUCKET, y // BUCKET) -> {actor: None}, in insertion order
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __contains__(self, pos):
+        return pos in self.cells
+
+    def at(self, x, y):
+        """Return the actor on a cell, or None"""
+        return self.cells.get((x, y))
+
+    def add(self, actor):
+        self.cells[(actor.x, actor.y)] = actor
+        key = (actor.x // self.BUCKET, actor.y // self.BUCKET)
+        self.buckets.setdefault(key, {})[actor] = None
+
+    def remove(self, actor):
+        if self.cells.get((actor.x, actor.y)) is actor:
+            del self.cells[(actor.x, actor.y)]
+            key = (actor.x // self.BUCKET, actor.y // self.BUCKET)
+            bucket = self.buckets[key]
+            del bucket[actor]
+            if not bucket:
+                del self.buckets[key]
+
+    def move(self, actor, x, y):
+        """Move an actor to a new cell, keeping the index up to date"""
+        self.remove(actor)
+        actor.x, actor.y = x, y
+        self.add(actor)
+
+    def in_rect(self, x1, y1, x2, y2):
+        """Return all actors inside the half-open rectangle [x1, x2) x [y1, y2)"""
+        if (x2 - x1) * (y2 - y1) < len(self.cells):
+            # Small rectangle: look up each cell
+            cells = self.cells
+            return [cells[(x, y)] for y in range(y1, y2) for x in range(x1, x2) if (x, y) in cells]
+        # Large rectangle: filter the actors of the overlapping buckets instead
+        return [a for a in self.in_buckets(x1, y1, x2, y2) if x1 <= a.x < x2 and y1 <= a.y < y2]
+
+    def in_buckets(self, x1, y1, x2, y2):
+        """Return the actors of every bucket overlapping [x1, x2) x [y1, y2), a superset of in_rect"""
+        b = self.BUCKET
+        bx1, by1 = x1 // b, y1 // b
+        bx2, by2 = (x2 - 1) // b, (y2 - 1) // b
+        if (bx2 - bx1 + 1) * (by2 - by1 + 1) >= len(self.buckets):
+            keys = [k for k in self.buckets if bx1 <= k[0] <= bx2 and by1 <= k[1] <= by2]
+        else:
+            keys = [(bx, by) for by in range(by1, by2 + 1) for bx in range(bx1, bx2 + 1)]
+        buckets = self.buckets
+        return [a for k in keys if k in buckets for a in buckets[k]]
+
+    def near(self, x, y, radius):
+        """Return all actors within Chebyshev distance radius of (x, y)"""
+        return self.in_rect(x - radius, y - radius, x + radius + 1, y + radius + 1)
+
+    def clear(self):
+        self.cells.clear()
+        self.buckets.clear()
+
+
+
+
+
+
+# Lays out rooms, tunnels and spawns on a TileMap with its own random number
+# generator. Enemies and items come out as plain data for Game.spawn, so that a
+# whole level can be built away from the main thread (see build_level).
+class LevelBuilder:
+    def __init__(self, rng, dungeon_level, tiles, player_pos=(0, 0), exit_pos=(0, 0)):
+        self.rng = rng  # random.Random: the game's own, or one seeded for a prepared level
+        self.dungeon_level = dungeon_level
+        self.tiles = tiles  # TileMap being carved
+        self.player_pos = player_pos
+        self.exit_pos = exit_pos  # Spawns avoid it; until build() is done that's still the previous level's exit
+        self.wall_color = STONE
+        self.floor_color = DARK_GRAY
+        self.enemies = []  # (x, y, kind, hp, attack, defense, exp, archetype), kind indexing ENEMY_TYPES
+        self.items = []  # (x, y, kind, amount), kind indexing ITEM_KINDS
+        self.enemy_cells = set()  # Tiles taken by the enemies above
+        self.item_cells = set()  # Same, items
     
     
     
-    # Generate a new dungeon layout
-    def generate_dungeon(self):
-        
+    def choose_colors(self):
+        rng = self.rng
         
         # Choose random colors for this level
-        self.wall_color = random.choice(WALL_PALETTE)
-        self.floor_color = random.choice(FLOOR_PALETTE)
+        self.wall_color = rng.choice(WALL_PALETTE)
+        self.floor_color = rng.choice(FLOOR_PALETTE)
         
         # Ensure wall and floor colors have enough contrast
         while (abs(self.wall_color[0] - self.floor_color[0]) + 
             abs(self.wall_color[1] - self.floor_color[1]) + 
             abs(self.wall_color[2] - self.floor_color[2])) < 60:
-            self.floor_color = random.choice(FLOOR_PALETTE)
-            
-            
-        # Reset map to all walls
-        self.tiles = [[Tile(x, y, 0) for x in range(self.map_width)] for y in range(self.map_height)]
-        self.entities = []
-        self.items = []
-        self.combat_log = []
+            self.floor_color = rng.choice(FLOOR_PALETTE)
+    
+    
+    
+    def build(self):
+        """Lay out a classic level over the whole map"""
+        rng = self.rng
+        self.choose_colors()
         
         # Generate rooms - larger and more at deeper levels
         rooms = []
@@ -444,22 +1634,23 @@ class Game:
         # Ensure player is placed in the first room
         player_placed = False
         
+        # Tiles covered by accepted rooms: a candidate intersects one of them
+        # (see Room.intersects) exactly when any tile of its rectangle is taken
+        occupied = np.zeros((self.tiles.height, self.tiles.width), dtype=bool)
+        
         # Randomly generate rooms
         for _ in range(max_rooms):
-            w = random.randint(min_room_size, max_room_size)
-            h = random.randint(min_room_size, max_room_size)
-            x = random.randint(1, self.map_width - w - 1)
-            y = random.randint(1, self.map_height - h - 1)
-            new_room = Room(x, y, w, h)
+            w = rng.randint(min_room_size, max_room_size)
+            h = rng.randint(min_room_size, max_room_size)
+            x = rng.randint(1, self.tiles.width - w - 1)
+            y = rng.randint(1, self.tiles.height - h - 1)
             
             # Check for intersections with other rooms
-            failed = False
-            for other_room in rooms:
-                if new_room.intersects(other_room):
-                    failed = True
-                    break
-            
-            if not failed:
+            footprint = occupied[y:y + h, x:x + w]
+            if not footprint.any():
+                new_room = Room(x, y, w, h)
+                footprint[:] = True
+                
                 # Carve out the room
                 self.carve_room(new_room)
                 
@@ -468,21 +1659,11 @@ class Game:
                 
                 # Place player in first room if not already placed
                 if not player_placed:
-                    self.player.x, self.player.y = new_x, new_y
+                    self.player_pos = (new_x, new_y)
                     player_placed = True
                 else:
                     # Connect to previous room with a tunnel
-                    prev_center = rooms[-1].center
-                    
-                    # Flip a coin (random number 0 or 1)
-                    if random.randint(0, 1) == 1:
-                        # First move horizontally, then vertically
-                        self.carve_h_tunnel(prev_center[0], new_x, prev_center[1])
-                        self.carve_v_tunnel(prev_center[1], new_y, new_x)
-                    else:
-                        # First move vertically, then horizontally
-                        self.carve_v_tunnel(prev_center[1], new_y, prev_center[0])
-                        self.carve_h_tunnel(prev_center[0], new_x, new_y)
+                    self.connect_rooms(rooms[-1], new_room)
                 
                 # Place entities
                 self.place_entities(new_room)
@@ -492,17 +1673,16 @@ class Game:
         
         # If no rooms were generated (shouldn't happen), place player at (1,1)
         if not player_placed:
-            self.player.x, self.player.y = 1, 1
-            self.tiles[1][1].type = 1  # Ensure it's a floor tile
+            self.player_pos = (1, 1)
+            self.tiles.set_type(1, 1, 1)  # Ensure it's a floor tile
         
         # Place exit in last room if rooms exist
         if rooms:
             last_room = rooms[-1]
             self.exit_pos = last_room.center
-            self.tiles[self.exit_pos[1]][self.exit_pos[0]].type = 2  # 2 = exit
+            self.tiles.set_type(self.exit_pos[0], self.exit_pos[1], 2)  # 2 = exit
         
-        # Update FOV after generation
-        self.update_fov()
+        return self
     
     
     
@@ -510,178 +1690,110 @@ class Game:
     
     def carve_room(self, room):
         # Set all tiles in the room to floor
-        for y in range(room.y + 1, room.y + room.h):
-            for x in range(room.x + 1, room.x + room.w):
-                self.tiles[y][x].type = 1  # Floor
+        self.tiles.carve(room.x + 1, room.y + 1, room.x + room.w, room.y + room.h)
     
     
     
     def carve_h_tunnel(self, x1, x2, y):
         # Horizontal tunnel
-        for x in range(min(x1, x2), max(x1, x2) + 1):
-            self.tiles[y][x].type = 1  # Floor
+        self.tiles.carve(min(x1, x2), y, max(x1, x2) + 1, y + 1)
     
     
     
     def carve_v_tunnel(self, y1, y2, x):
         # Vertical tunnel
-        for y in range(min(y1, y2), max(y1, y2) + 1):
-            self.tiles[y][x].type = 1  # Floor
-    
-    
+        self.tiles.carve(x, min(y1, y2), x + 1, max(y1, y2) + 1)
     
     
     
+    def connect_rooms(self, prev_room, new_room):
+        # L-shaped tunnel between the two room centers
+        prev_center = prev_room.center
+        new_x, new_y = new_room.center
+        
+        # Flip a coin (random number 0 or 1)
+        if self.rng.randint(0, 1) == 1:
+            # First move horizontally, then vertically
+            self.carve_h_tunnel(prev_center[0], new_x, prev_center[1])
+            self.carve_v_tunnel(prev_center[1], new_y, new_x)
+        else:
+            # First move vertically, then horizontally
+            self.carve_v_tunnel(prev_center[1], new_y, prev_center[0])
+            self.carve_h_tunnel(prev_center[0], new_x, new_y)
     
     
     
     
     
     def place_entities(self, room):
-
-
-
-        # Place enemies - more enemies and stronger as dungeon level increases
-        num_enemies = random.randint(0, 2 + self.dungeon_level // 2)  # More enemies at deeper levels
+        rng = self.rng
         
-        enemy_types = ["goblin", "orc", "skeleton", "zombie", "troll", "ghost"]
-        enemy_chars = ["g", "o", "s", "z", "T", "G"]
-        enemy_colors = [GREEN, GREEN, WHITE, WHITE, GREEN, PURPLE]
+        # Place enemies - more enemies and stronger as dungeon level increases
+        num_enemies = rng.randint(0, 2 + self.dungeon_level // 2)  # More enemies at deeper levels
         
         for _ in range(num_enemies):
             # Choose random position in room
-            x = random.randint(room.x + 1, room.x + room.w - 1)
-            y = random.randint(room.y + 1, room.y + room.h - 1)
+            x = rng.randint(room.x + 1, room.x + room.w - 1)
+            y = rng.randint(room.y + 1, room.y + room.h - 1)
             
             # Only place if it's a floor and not occupied
-            if (self.tiles[y][x].type == 1 and 
-                not any(e.x == x and e.y == y for e in self.entities) and
-                (x, y) != (self.player.x, self.player.y) and
+            if (self.tiles.type[y, x] == 1 and 
+                (x, y) not in self.enemy_cells and
+                (x, y) != self.player_pos and
                 (x, y) != self.exit_pos):
                 
-                enemy_type = random.randint(0, len(enemy_types)-1)
-                special = {}
+                enemy_type = rng.randint(0, len(ENEMY_TYPES)-1)
                 
-                # Base stats for all enemies (will be overridden by specific types)
-                hp = 15 + (self.dungeon_level - 1) * 3
-                attack = 5 + (self.dungeon_level - 1)
-                defense = 1 + (self.dungeon_level - 1)
-                exp = 10 + (self.dungeon_level - 1) * 2
-                
-                # Enemy-specific stats and abilities
-                if enemy_types[enemy_type] == "goblin":
-                    # Fast but weak enemies
-                    hp = random.randint(25, 35) + (self.dungeon_level - 1) * 2
-                    attack = random.randint(3, 6) + (self.dungeon_level - 1)
-                    defense = random.randint(0, 2) + (self.dungeon_level - 1)
-                    exp = random.randint(8, 15) + (self.dungeon_level - 1)
-                    special["double_attack_chance"] = 0.2  # 20% chance to attack twice
-                    
-                elif enemy_types[enemy_type] == "orc":
-                    # Strong warriors with critical hits
-                    hp = random.randint(35, 45) + (self.dungeon_level - 1) * 5
-                    attack = random.randint(6, 10) + (self.dungeon_level - 1) * 2 + 5  # +5 attack bonus
-                    defense = random.randint(2, 4) + (self.dungeon_level - 1)
-                    exp = random.randint(15, 30) + (self.dungeon_level - 1) * 2
-                    special["crit_chance"] = 0.15  # 15% chance to crit
-                    special["crit_multiplier"] = 1.5  # 1.5x damage on crit
-                    
-                elif enemy_types[enemy_type] == "skeleton":
-                    # Fragile but accurate and dodgy
-                    hp = random.randint(20, 25) + (self.dungeon_level - 1) * 2
-                    attack = random.randint(5, 8) + (self.dungeon_level - 1)
-                    defense = random.randint(1, 3) + (self.dungeon_level - 1)
-                    exp = random.randint(10, 20) + (self.dungeon_level - 1)
-                    special["accuracy_bonus"] = 2  # +2 to hit
-                    special["dodge_chance"] = 0.15  # 15% chance to dodge
-                    
-                elif enemy_types[enemy_type] == "zombie":
-                    # Slow but tanky with poison
-                    hp = random.randint(30, 40) + (self.dungeon_level - 1) * 6
-                    attack = random.randint(4, 7) + (self.dungeon_level - 1)
-                    defense = random.randint(3, 5) + (self.dungeon_level - 1)
-                    exp = random.randint(12, 22) + (self.dungeon_level - 1)
-                    special["poison_chance"] = 0.3  # 30% chance to poison
-                    special["poison_damage"] = 2  # 2 damage per turn
-                    special["poison_duration"] = 3  # 3 turns
-                    
-                elif enemy_types[enemy_type] == "troll":
-                    # Regenerating brutes
-                    hp = random.randint(35, 50) + (self.dungeon_level - 1) * 8
-                    attack = random.randint(7, 12) + (self.dungeon_level - 1) * 2
-                    defense = random.randint(2, 4) + (self.dungeon_level - 1)
-                    exp = random.randint(25, 40) + (self.dungeon_level - 1) * 3
-                    special["regeneration"] = True
-                    special["regen_amount"] = 3 + self.dungeon_level  # 3-5 HP per turn
-                    
-                elif enemy_types[enemy_type] == "ghost":
-                    # Ethereal and hard to hit
-                    hp = random.randint(20, 30) + (self.dungeon_level - 1) * 3
-                    attack = random.randint(5, 9) + (self.dungeon_level - 1)
-                    defense = random.randint(4, 6) + (self.dungeon_level - 1) + 2  # +2 defense bonus
-                    exp = random.randint(20, 35) + (self.dungeon_level - 1) * 2
-                    special["dodge_chance"] = 0.25  # 25% chance to dodge
-                    special["life_drain"] = 0.25  # 10% of damage heals ghost
+                # Enemy-specific stats, rolled in table order, and abilities
+                archetype = enemy_archetype(enemy_type, self.dungeon_level)
+                hp, attack, defense, exp = (rng.randint(low, high) + offset for low, high, offset in archetype.stats)
                     
-                enemy = Entity(x, y, enemy_chars[enemy_type], enemy_colors[enemy_type], 
-                            enemy_types[enemy_type], hp, attack, defense, exp)
-                if special:
-                    enemy.special = special
-                self.entities.append(enemy)
+                self.enemies.append((x, y, enemy_type, hp, attack, defense, exp, archetype))
+                self.enemy_cells.add((x, y))
 
 
 
 
             # Place items - better items at deeper levels
-            if random.random() < 1:  # Increased chance for items (100%)
+            if rng.random() < 1:  # Increased chance for items (100%)
                 # Try to find a valid position (up to 10 attempts)
                 attempts = 0
                 placed = False
                 while attempts < 10 and not placed:
-                    x = random.randint(room.x + 1, room.x + room.w - 1)
-                    y = random.randint(room.y + 1, room.y + room.h - 1)
+                    x = rng.randint(room.x + 1, room.x + room.w - 1)
+                    y = rng.randint(room.y + 1, room.y + room.h - 1)
                     
                     # Check if position is valid
-                    if (self.tiles[y][x].type == 1 and 
-                        not any(e.x == x and e.y == y for e in self.entities) and
-                        not any(i.x == x and i.y == y for i in self.items) and
-                        (x, y) != (self.player.x, self.player.y) and
+                    if (self.tiles.type[y, x] == 1 and 
+                        (x, y) not in self.enemy_cells and
+                        (x, y) not in self.item_cells and
+                        (x, y) != self.player_pos and
                         (x, y) != self.exit_pos):
                         
                         # Simplified item selection with higher treasure chance
-                        item_type = random.choices(
+                        item_type = rng.choices(
                             ["health", "weapon", "armor", "treasure", "gold"],
                             weights=[30, 20, 20, 20, 40],  # 30% health, 20% weapon, 20% armor, 20% treasure, %40 gold
                             k=1
                         )[0]
                         
                         if item_type == "gold":
-                            gold_amount = random.randint(5, 15) + self.dungeon_level  # Small amount
-                            gold = Entity(x, y, "$", GOLD, "Gold")
-                            gold.effect = "gold"
-                            gold.amount = gold_amount
-                            self.items.append(gold)
+                            gold_amount = rng.randint(5, 15) + self.dungeon_level  # Small amount
+                            self.items.append((x, y, 0, gold_amount))  # Gold
                         elif item_type == "treasure":
-                            gold_amount = random.randint(25, 100) + (self.dungeon_level * 10)  # Large amount
-                            treasure = Entity(x, y, "T", YELLOW, "Treasure")  # Different character/color
-                            treasure.effect = "gold"  # Same effect but different amount
-                            treasure.amount = gold_amount
-                            self.items.append(treasure)
+                            gold_amount = rng.randint(25, 100) + (self.dungeon_level * 10)  # Large amount
+                            # Different character/color, same effect but different amount
+                            self.items.append((x, y, 1, gold_amount))  # Treasure
                         elif item_type == "health":
-                            item = Entity(x, y, "H", RED, "Health Potion")
-                            item.effect = "heal"
-                            item.amount = random.randint(10, 25) + (self.dungeon_level - 1) * 5
-                            self.items.append(item)
+                            amount = rng.randint(10, 25) + (self.dungeon_level - 1) * 5
+                            self.items.append((x, y, 2, amount))  # Health Potion
                         elif item_type == "weapon":
-                            item = Entity(x, y, "W", BLUE, "Weapon")
-                            item.effect = "attack"
-                            item.amount = random.randint(1, 3) + (self.dungeon_level - 1)
-                            self.items.append(item)
+                            amount = rng.randint(1, 3) + (self.dungeon_level - 1)
+                            self.items.append((x, y, 3, amount))  # Weapon
                         else:  # armor
-                            item = Entity(x, y, "A", BLUE, "Armor")
-                            item.effect = "defense"
-                            item.amount = random.randint(1, 2) + (self.dungeon_level - 1)
-                            self.items.append(item)
+                            amount = rng.randint(1, 2) + (self.dungeon_level - 1)
+                            self.items.append((x, y, 4, amount))  # Armor
+                        self.item_cells.add((x, y))
                         
                         placed = True
                         
@@ -689,27 +1801,493 @@ class Game:
 
 
 
+def build_level(seed, dungeon_level, width, height, exit_pos):
+    """Build a classic level from a seed without touching any shared state"""
+    tiles = TileMap(width, height)
+    return LevelBuilder(random.Random(seed), dungeon_level, tiles, exit_pos=exit_pos).build()
 
 
-    def update_fov(self):
-        # Reset current visibility (but keep explored state)
-        for y in range(self.map_height):
-            for x in range(self.map_width):
-                self.tiles[y][x].visible = False
+
+
+
+
+class Game:
+    
+    # Represents the main game state
+    def __init__(self, map_width=MAP_SIZE, map_height=MAP_SIZE, seed=None, generate=True):
+        # Maps bigger than the classic size are generated chunk by chunk, so they come in whole chunks
+        self.chunked = map_width > MAP_SIZE or map_height > MAP_SIZE
+        if self.chunked:
+            map_width = -(-map_width // TileMap.CHUNK) * TileMap.CHUNK
+            map_height = -(-map_height // TileMap.CHUNK) * TileMap.CHUNK
+        self.map_width = map_width
+        self.map_height = map_height
+        self.tiles = TileMap(self.map_width, self.map_height)
+        self.map_layer = MapLayer(self.map_width, self.map_height)  # Cached rendering of the tiles
+        self.minimap = Minimap(self.map_width, self.map_height)  # Same, for the minimap
+        self.presenter = Presenter()  # Dirty rectangles to send to the display
+        self.profiler = FrameProfiler()  # Frame timings for the F3 overlay and --perf-log
+        self.fov_box = None  # Map rectangle covered by the last FOV update
+        self.fov_cells = None  # Flat indices of the tiles lit by the last FOV update
+        self.fov_cache = {}  # (x, y, radius) -> lit tiles, valid for one tiles.version
+        self.fov_version = -1
+        self.entities = ActorStore(Enemy)  # Enemies of the current level
+        self.items = ActorStore(Item)  # Items of the current level
+        self.entity_index = SpatialIndex()  # Enemies by position
+        self.item_index = SpatialIndex()  # Items by position
+        self.autosave = None  # Path the game is saved to after every turn
+        self.max_log_entries = 10
+        self.events = EventLog(self.max_log_entries)  # Messages and combat log
+        # Every random draw of the game comes from here, so a seed (drawn from the random
+        # module if not given) and the actions played reproduce a session exactly
+        self.seed = random.getrandbits(64) if seed is None else seed
+        self.rng = random.Random(self.seed)
+        self.recorder = None  # Recorder the actions played are written to
+        self.reset(generate)
+    
+    
+    
+    def reset(self, generate=True):
+        """Start a new game, keeping the map storage, rendering layers and loaded assets
+
+        generate=False leaves the first level out (and prefetches nothing), for load to fill in.
+        """
+        if self.recorder is not None:
+            self.recorder.record(ACTION_RESTART)
+        self.player = Player(0, 0)  # Initialize player with dummy position
+        self.entities.clear()
+        self.items.clear()
+        self.spawn_count = 0  # Last Enemy.seq handed out
+        self.exit_pos = (0, 0)
+        self.exit_chunk = None  # Chunk holding the exit on chunked maps
+        self.gate_x = None  # Chunked maps: x offset of the gate from each chunk to the one below it
+        self.gate_y = None  # Same, y offset of the gate to the chunk on the right
+        self.next_level = None  # (build_level arguments, result, worker) of the level being prepared
+        self.events.clear()
+        self.camera_x = 0
+        self.camera_y = 0
+        self.game_state = "playing"
+        self.dungeon_level = 1
+        self.wall_color = STONE  # Default
+        self.floor_color = DARK_GRAY  # Default
+        self.enemy_agro_range = 1  # Base agro range
+        self.chase = None  # Steps to the player around their tile, see chase_map
+        self.chase_key = None  # (player x, player y, agro range, tiles version) chase belongs to
+        if generate:
+            self.generate_dungeon()
+    
+    
+    
+    
+    
+    
+    # Generate a new dungeon layout. Classic levels come from a LevelBuilder, either
+    # one built in the background by prepare_next_level or one built right here.
+    def generate_dungeon(self, builder=None):
+        if self.chunked:
+            builder = LevelBuilder(self.rng, self.dungeon_level, self.tiles)
+            builder.choose_colors()
+            self.reset_level(builder.wall_color, builder.floor_color)
+            self.start_chunked_level()
+            self.update_fov()
+            return
+        
+        if builder is None:
+            tiles = TileMap(self.map_width, self.map_height)
+            builder = LevelBuilder(self.rng, self.dungeon_level, tiles, exit_pos=self.exit_pos).build()
         
+        self.reset_level(builder.wall_color, builder.floor_color)
+        self.tiles.load(builder.tiles.type)
+        self.player.x, self.player.y = builder.player_pos
+        self.exit_pos = builder.exit_pos
+        self.spawn(builder)
+        
+        # Update FOV after generation
+        self.update_fov()
+        self.prepare_next_level()
+    
+    
+    
+    def reset_level(self, wall_color, floor_color):
+        self.wall_color = wall_color
+        self.floor_color = floor_color
+        
+        # Reset map to all walls
+        self.tiles.reset()
+        self.map_layer.set_colors(self.wall_color, self.floor_color)
+        self.map_layer.clear()
+        self.minimap.set_colors(self.wall_color, self.floor_color)
+        self.minimap.clear()
+        self.fov_box = None
+        self.fov_cells = None
+        self.entities.clear()
+        self.alive_by_seq = bytearray()  # alive_by_seq[seq] is 1 while the enemy spawned as seq lives
+        self.items.clear()
+        self.entity_index.clear()
+        self.item_index.clear()
+        self.events.new_level()
+    
+    
+    
+    def spawn(self, builder):
+        """Create the enemies and items a LevelBuilder placed"""
+        for x, y, kind, hp, attack, defense, exp, archetype in builder.enemies:
+            self.add_entity(x, y, kind, hp, hp, attack, defense, exp, archetype)
+        for x, y, kind, amount in builder.items:
+            self.add_item(x, y, kind, amount)
+    
+    
+    
+    def prepare_next_level(self, seed=None):
+        """Start building the level below on a worker thread, so that descending doesn't stall"""
+        # The seed is drawn here, so the level is the same whichever thread ends up building it
+        if seed is None:
+            seed = self.rng.getrandbits(64)
+        args = (seed, self.dungeon_level + 1, self.map_width, self.map_height, self.exit_pos)
+        done = {}
+        worker = threading.Thread(target=lambda: done.setdefault("level", build_level(*args)), daemon=True)
+        worker.start()
+        self.next_level = (args, done, worker)
+    
+    
+    
+    def wait_for_next_level(self):
+        """Block until the worker started by prepare_next_level is done (e.g. before timing something)"""
+        if self.next_level is not None:
+            self.next_level[2].join()
+    
+    
+    
+    def take_next_level(self):
+        """The level prepared by prepare_next_level, waiting for the worker if it isn't done yet"""
+        if self.next_level is None:
+            return None
+        args, done, worker = self.next_level
+        self.next_level = None
+        worker.join()
+        # Built here only if the worker raised and left no level behind
+        return done.get("level") or build_level(*args)
+    
+    
+    
+    def save(self, path):
+        """Write the game to path in the binary save format (see SAVE_HEADER)"""
+        parts = self.save_parts()
+        
+        # Write next to the old save and swap, so a crash never leaves half a file behind
+        with open(path + ".tmp", "wb") as f:
+            for part in parts:
+                f.write(part.tobytes())
+        os.replace(path + ".tmp", path)
+    
+    def state_hash(self):
+        """8-byte digest of everything a save holds, random number generator included"""
+        digest = hashlib.blake2b(digest_size=8)
+        for part in self.save_parts():
+            digest.update(part.tobytes())
+        return digest.digest()
+    
+    def save_parts(self):
+        """The sections of a save file, as NumPy arrays"""
+        header = np.zeros((), np.dtype(SAVE_HEADER))
+        header["magic"] = SAVE_MAGIC
+        header["version"] = SAVE_VERSION
+        header["width"], header["height"] = self.map_width, self.map_height
+        header["dungeon_level"] = self.dungeon_level
+        header["enemies"], header["items"] = len(self.entities), len(self.items)
+        header["exit_x"], header["exit_y"] = self.exit_pos
+        header["exit_chunk_x"], header["exit_chunk_y"] = self.exit_chunk or (-1, -1)
+        header["wall_color"], header["floor_color"] = self.wall_color, self.floor_color
+        header["agro_range"] = self.enemy_agro_range
+        header["spawn_count"] = self.spawn_count
+        header["game_over"] = self.game_state == "game_over"
+        if self.next_level is not None:
+            header["has_next_level"] = True
+            header["next_level_seed"] = self.next_level[0][0]
+        _, rng_state, gauss = self.rng.getstate()
+        header["rng_state"] = rng_state
+        if gauss is not None:
+            header["has_gauss"], header["gauss"] = True, gauss
+        
+        player = np.zeros((), np.dtype(SAVE_PLAYER))
+        for name in player.dtype.names:
+            if name != "last_direction":
+                player[name] = getattr(self.player, name)
+        player["last_direction"] = self.player.last_direction == "right"
+        
+        # Enemies go in spawn order, whatever order their store slots are in
+        enemies = np.zeros(len(self.entities), np.dtype(SAVE_ENEMY))
+        order = np.argsort(self.entities.column("seq"), kind="stable")
+        for name in ("x", "y", "kind", "seq", "hp", "max_hp", "attack", "defense", "exp"):
+            enemies[name] = self.entities.column(name)[order]
+        archetype_ids = self.entities.column("archetype_id")[order]
+        for archetype_id in np.unique(archetype_ids).tolist():
+            rows = archetype_ids == archetype_id
+            special = ARCHETYPES[archetype_id].special
+            for bit, (name, _) in enumerate(SPECIAL_ABILITIES):
+                if name in special:
+                    enemies["abilities"][rows] |= 1 << bit
+                    enemies[name][rows] = special[name]
+        
+        items = np.zeros(len(self.items), np.dtype(SAVE_ITEM))
+        for name in items.dtype.names:
+            items[name] = self.items.column(name)
+        
+        types = self.tiles.type.reshape(-1)
+        parts = [header, player, np.packbits(types & 1), np.packbits(types >> 1), self.tiles.explored_bits]
+        if self.chunked:
+            parts += [np.packbits(self.tiles.generated), self.gate_x.astype(np.uint8), self.gate_y.astype(np.uint8)]
+        parts += [enemies, items]
+        return parts
+    
+    
+    
+    def load(self, save):
+        """Replace the current game with a save read by read_save (the map sizes must match)"""
+        header = save["header"]
+        width, height = int(header["width"]), int(header["height"])
+        if (width, height) != (self.map_width, self.map_height):
+            raise ValueError(f"save is for a {width}x{height} map, not {self.map_width}x{self.map_height}")
+        
+        self.dungeon_level = int(header["dungeon_level"])
+        self.reset_level(tuple(header["wall_color"].tolist()), tuple(header["floor_color"].tolist()))
+        types = np.unpackbits(save["types_low"], count=width * height)
+        types |= np.unpackbits(save["types_high"], count=width * height) << 1
+        self.tiles.load(types.reshape(height, width))
+        self.tiles.explored_bits[:] = save["explored"]
+        # reset_level left nothing to repaint, but the explored tiles are all on screen now
+        self.map_layer.invalidate_all()
+        self.minimap.invalidate_all()
+        if self.chunked:
+            self.tiles.generated[:] = np.unpackbits(save["generated"], count=self.tiles.generated.size).reshape(
+                self.tiles.generated.shape)
+            self.gate_x, self.gate_y = save["gate_x"].astype(int), save["gate_y"].astype(int)
+            self.exit_chunk = (int(header["exit_chunk_x"]), int(header["exit_chunk_y"]))
+        self.exit_pos = (int(header["exit_x"]), int(header["exit_y"]))
+        self.enemy_agro_range = int(header["agro_range"])
+        self.game_state = "game_over" if header["game_over"] else "playing"
+        
+        # Player
+        record = save["player"]
+        for name in record.dtype.names:
+            if name not in ("last_direction", "facing_right"):
+                setattr(self.player, name, record[name].item())
+        self.player.poisoned = bool(record["poisoned"])
+        self.player.last_direction = "right" if record["last_direction"] else "left"
+        self.player.face(bool(record["facing_right"]))
+        
+        # Enemies and items, in their original order. Enemies with the same abilities share
+        # an Archetype, the level's own one if the abilities still match it.
+        archetypes = {}
+        for record in save["enemies"].tolist():
+            x, y, kind, seq, hp, max_hp, attack, defense, exp, abilities = record[:10]
+            key = tuple(record[9:])
+            if key not in archetypes:
+                special = {name: kind_of(value) for bit, ((name, kind_of), value)
+                           in enumerate(zip(SPECIAL_ABILITIES, record[10:])) if abilities >> bit & 1}
+                archetype = enemy_archetype(kind, self.dungeon_level)
+                if special != archetype.special:
+                    archetype = Archetype(special) if special else NO_ABILITIES
+                archetypes[key] = archetype
+            self.add_entity(x, y, kind, hp, max_hp, attack, defense, exp, archetypes[key], seq)
+        self.spawn_count = int(header["spawn_count"])
+        for x, y, kind, amount in save["items"].tolist():
+            self.add_item(x, y, kind, amount)
+        
+        # Random number generator and the level being prepared
+        rng_state = tuple(header["rng_state"].tolist())
+        self.rng.setstate((3, rng_state, float(header["gauss"]) if header["has_gauss"] else None))
+        self.next_level = None
+        if header["has_next_level"]:
+            self.prepare_next_level(int(header["next_level_seed"]))
+        
+        self.chase_key = None
+        self.update_fov()
+        self.presenter.invalidate_all()
+        self.events.record("loaded")
+    
+    
+    
+    
+    
+    # Large maps: only the chunks around the player are laid out, the rest is
+    # generated as they come into reach. Every chunk has its first room centered
+    # on the chunk, and neighbouring chunks are joined through "gates" on their
+    # shared border whose positions are drawn for the whole level up front.
+    def start_chunked_level(self):
+        c = TileMap.CHUNK
+        chunks_x, chunks_y = self.tiles.chunks_x, self.tiles.chunks_y
+        gates = np.random.default_rng(self.rng.getrandbits(32))
+        self.gate_x = gates.integers(4, c - 4, (chunks_y, chunks_x))
+        self.gate_y = gates.integers(4, c - 4, (chunks_y, chunks_x))
+        
+        # Start in the middle of the map, with the exit in any other chunk
+        start = (chunks_x // 2, chunks_y // 2)
+        exit_index = self.rng.randrange(chunks_x * chunks_y - 1)
+        if exit_index >= start[1] * chunks_x + start[0]:
+            exit_index += 1
+        self.exit_chunk = (exit_index % chunks_x, exit_index // chunks_x)
+        self.player.x, self.player.y = self.chunk_anchor(*start)
+        self.exit_pos = self.chunk_anchor(*self.exit_chunk)
+
+    def chunk_anchor(self, cx, cy):
+        # Center of a chunk, where its first room sits
+        return cx * TileMap.CHUNK + TileMap.CHUNK // 2, cy * TileMap.CHUNK + TileMap.CHUNK // 2
+
+    def ensure_chunks(self, x, y, reach):
+        """Generate every chunk within reach tiles of (x, y) that doesn't exist yet"""
+        c = TileMap.CHUNK
+        cx1, cy1 = max(0, (x - reach) // c), max(0, (y - reach) // c)
+        cx2 = min(self.tiles.chunks_x - 1, (x + reach) // c)
+        cy2 = min(self.tiles.chunks_y - 1, (y + reach) // c)
+        for cy in range(cy1, cy2 + 1):
+            for cx in range(cx1, cx2 + 1):
+                if not self.tiles.generated[cy, cx]:
+                    self.generate_chunk(cx, cy)
+
+    def generate_chunk(self, cx, cy):
+        c = TileMap.CHUNK
+        x0, y0 = cx * c, cy * c
+        anchor_x, anchor_y = self.chunk_anchor(cx, cy)
+        self.tiles.generated[cy, cx] = True
+        builder = LevelBuilder(self.rng, self.dungeon_level, self.tiles, (self.player.x, self.player.y), self.exit_pos)
+        
+        # Rooms chained together like on a classic level, a few more at deeper levels
+        rooms = []
+        for _ in range(4 + self.dungeon_level // 2):
+            w = self.rng.randint(8, 16)
+            h = self.rng.randint(8, 16)
+            if rooms:
+                x = self.rng.randint(x0 + 1, x0 + c - w - 1)
+                y = self.rng.randint(y0 + 1, y0 + c - h - 1)
+            else:
+                x, y = anchor_x - w // 2, anchor_y - h // 2
+            new_room = Room(x, y, w, h)
+            if any(new_room.intersects(other_room) for other_room in rooms):
+                continue
+            builder.carve_room(new_room)
+            if rooms:
+                builder.connect_rooms(rooms[-1], new_room)
+            builder.place_entities(new_room)
+            rooms.append(new_room)
+        
+        # Corridors from the first room to the gates on each side that has a neighbour
+        if cx + 1 < self.tiles.chunks_x:
+            gate_y = y0 + self.gate_y[cy, cx]
+            builder.carve_v_tunnel(anchor_y, gate_y, anchor_x)
+            builder.carve_h_tunnel(anchor_x, x0 + c - 1, gate_y)
+        if cx > 0:
+            gate_y = y0 + self.gate_y[cy, cx - 1]
+            builder.carve_v_tunnel(anchor_y, gate_y, anchor_x)
+            builder.carve_h_tunnel(x0, anchor_x, gate_y)
+        if cy + 1 < self.tiles.chunks_y:
+            gate_x = x0 + self.gate_x[cy, cx]
+            builder.carve_h_tunnel(anchor_x, gate_x, anchor_y)
+            builder.carve_v_tunnel(anchor_y, y0 + c - 1, gate_x)
+        if cy > 0:
+            gate_x = x0 + self.gate_x[cy - 1, cx]
+            builder.carve_h_tunnel(anchor_x, gate_x, anchor_y)
+            builder.carve_v_tunnel(y0, anchor_y, gate_x)
+        
+        self.spawn(builder)
+        
+        if (cx, cy) == self.exit_chunk:
+            self.tiles.set_type(self.exit_pos[0], self.exit_pos[1], 2)  # 2 = exit
+        
+        self.map_layer.invalidate(x0, y0, x0 + c, y0 + c)
+        self.minimap.invalidate(x0, y0, x0 + c, y0 + c)
+    
+    
+    
+    
+    
+    
+    
+    
+    
+    
+    # Keep the entity/item stores and their spatial indexes in sync
+    def add_entity(self, x, y, kind, hp, max_hp, attack, defense, exp, archetype, seq=None):
+        """Add an enemy of kind ENEMY_TYPES[kind], spawned next unless seq is given; returns its handle"""
+        if seq is None:
+            self.spawn_count += 1
+            seq = self.spawn_count
+        entity = self.entities.add(x, y, kind, hp, max_hp, attack, defense, exp, archetype.id, seq, 0)
+        self.entity_index.add(entity)
+        if len(self.alive_by_seq) <= seq:
+            self.alive_by_seq.extend(bytes(seq + 1 - len(self.alive_by_seq)))
+        self.alive_by_seq[seq] = 1
+        return entity
+
+    def remove_entity(self, entity):
+        self.alive_by_seq[entity.seq] = 0
+        self.entity_index.remove(entity)
+        self.entities.remove(entity)
+
+    def add_item(self, x, y, kind, amount):
+        """Add an item of kind ITEM_KINDS[kind]; returns its handle"""
+        item = self.items.add(x, y, kind, amount)
+        self.item_index.add(item)
+        return item
+
+    def remove_item(self, item):
+        self.item_index.remove(item)
+        self.items.remove(item)
+
+
+
+
+
+    def update_fov(self):
         # Use Bresenham's line algorithm for symmetric FOV
         radius = self.player.vision_radius
         cx, cy = self.player.x, self.player.y
         
-        # Mark player's tile as visible
-        self.tiles[cy][cx].visible = True
-        self.tiles[cy][cx].explored = True
-        
-        # Check all octants for visibility
-        for octant in range(8):
-            self.cast_light(cx, cy, 1, 1.0, 0.0, radius, octant)
-
-    def cast_light(self, cx, cy, row, start_slope, end_slope, radius, octant):
+        # Lay out the chunks the player is about to see
+        if self.chunked:
+            self.ensure_chunks(cx, cy, radius + CHUNK_MARGIN)
+        
+        # Cached results are only valid while no tile has changed opacity
+        if self.fov_version != self.tiles.version:
+            self.fov_cache.clear()
+            self.fov_version = self.tiles.version
+        
+        # Walking back and forth reuses the cells computed last time
+        key = (cx, cy, radius)
+        cells = self.fov_cache.get(key)
+        if cells is None:
+            # Player's tile is always visible
+            lit = [cy * self.map_width + cx]
+            
+            # Check all octants for visibility
+            for octant in range(8):
+                self.cast_light(cx, cy, 1, 1.0, 0.0, radius, octant, lit)
+            cells = np.unique(np.array(lit, dtype=np.int32))
+            
+            if len(self.fov_cache) >= 4096:
+                self.fov_cache.clear()
+            self.fov_cache[key] = cells
+        
+        # Reset previous visibility (but keep explored state), then light the new cells
+        visible = self.tiles.visible.reshape(-1)
+        if self.fov_cells is None:
+            self.tiles.clear_visible()
+        else:
+            visible[self.fov_cells] = False
+        visible[cells] = True
+        self.tiles.mark_explored(cells)
+        self.fov_cells = cells
+        
+        # Only tiles around the old and new position can change state
+        if self.fov_box:
+            self.map_layer.invalidate(*self.fov_box)
+            self.minimap.invalidate(*self.fov_box)
+        self.fov_box = (cx - radius, cy - radius, cx + radius + 1, cy + radius + 1)
+        self.map_layer.invalidate(*self.fov_box)
+        self.minimap.invalidate(*self.fov_box)
+
+    def cast_light(self, cx, cy, row, start_slope, end_slope, radius, octant, lit):
+        # Appends the flat index (y * map_width + x) of every lit tile to lit
         if start_slope < end_slope:
             return
         
@@ -739,21 +2317,20 @@ class Game:
                     
                 # Check if within lightable area
                 if dx*dx + dy*dy < radius_squared:
-                    self.tiles[ny][nx].visible = True
-                    self.tiles[ny][nx].explored = True
+                    lit.append(ny * self.map_width + nx)
                     
                 if blocked:
                     # Previous cell was blocking
-                    if self.tiles[ny][nx].type == 0:  # Wall
+                    if self.tiles.type[ny, nx] == 0:  # Wall
                         new_start_slope = r_slope
                         continue
                     else:
                         blocked = False
                         start_slope = new_start_slope
                 else:
-                    if self.tiles[ny][nx].type == 0 and j < radius:  # Wall
+                    if self.tiles.type[ny, nx] == 0 and j < radius:  # Wall
                         blocked = True
-                        self.cast_light(cx, cy, j + 1, start_slope, l_slope, radius, octant)
+                        self.cast_light(cx, cy, j + 1, start_slope, l_slope, radius, octant, lit)
                         new_start_slope = r_slope
                         
             if blocked:
@@ -789,48 +2366,58 @@ class Game:
 
 
 
+    def play(self, action):
+        """Play an action as a replay file records it (see REPLAY_HEADER)"""
+        if action == ACTION_POISON:
+            self.handle_poison()
+        elif action == ACTION_RESTART:
+            self.reset()
+        else:
+            self.move_player(action // 3 - 1, action % 3 - 1)
+    
     def move_player(self, dx, dy):
+        if self.recorder is not None:
+            self.recorder.record((dx + 1) * 3 + dy + 1)
         new_x, new_y = self.player.x + dx, self.player.y + dy
         
         # Check bounds
         if new_x < 0 or new_y < 0 or new_x >= self.map_width or new_y >= self.map_height:
-            self.add_message("You can't go that way!")
+            self.events.record("blocked")
             return
         
         # Update facing direction before moving
         if dx > 0:  # Moving right
             self.player.last_direction = "right"
-            self.player.sprite = self.player.right_sprite
+            self.player.face(True)
         elif dx < 0:  # Moving left
             self.player.last_direction = "left"
-            self.player.sprite = self.player.left_sprite
+            self.player.face(False)
         
         # Check walls
-        if self.tiles[new_y][new_x].type == 0:
-            self.add_message("You can't walk through walls!")
+        if self.tiles.type[new_y, new_x] == 0:
+            self.events.record("wall")
             return
         
         # Check exit
         if (new_x, new_y) == self.exit_pos:
             self.dungeon_level += 1
-            self.add_message(f"Descending to dungeon level {self.dungeon_level}...")
-            self.generate_dungeon()
-            self.update_fov()
+            self.events.record("descend", amount=self.dungeon_level)
+            self.generate_dungeon(self.take_next_level())  # Also updates the FOV
             return
         
         # Check entities
-        for entity in self.entities[:]:
-            if (entity.x, entity.y) == (new_x, new_y):
-                self.fight(entity)
-                return
+        entity = self.entity_index.at(new_x, new_y)
+        if entity:
+            self.fight(entity)
+            return
         
         # Check items
-        for item in self.items[:]:
-            if (item.x, item.y) == (new_x, new_y):
-                self.pick_up_item(item)
-                self.player.x, self.player.y = new_x, new_y
-                self.update_fov()
-                return
+        item = self.item_index.at(new_x, new_y)
+        if item:
+            self.pick_up_item(item)
+            self.player.x, self.player.y = new_x, new_y
+            self.update_fov()
+            return
         
         # Move player
         self.player.x, self.player.y = new_x, new_y
@@ -842,30 +2429,24 @@ class Game:
 
 
     def handle_special_effects(self, attacker, defender):
+        archetype = attacker.archetype  # The player's has no abilities
+        
         # Handle poison effects
-        if (hasattr(attacker, 'special') and 'poison_chance' in attacker.special and
-            random.random() < attacker.special['poison_chance'] and
-            defender == self.player):
+        if archetype.poisons and self.rng.random() < archetype.poison_chance and defender is self.player:
             self.player.poisoned = True
-            self.player.poison_damage = attacker.special.get('poison_damage', 1)
-            self.player.poison_duration = attacker.special.get('poison_duration', 2)
-            self.add_message(f"You were poisoned by {attacker.name}!")
-            self.add_to_log(f"Poisoned! {self.player.poison_damage} damage per turn for {self.player.poison_duration} turns")
+            self.player.poison_damage = archetype.poison_damage
+            self.player.poison_duration = archetype.poison_duration
+            self.events.record("poisoned", attacker.name, None, self.player.poison_damage, self.player.poison_duration)
         
         # Handle regeneration
-        if (hasattr(attacker, 'special') and 'regeneration' in attacker.special and
-            attacker != self.player and attacker.alive):
-            regen_amount = attacker.special.get('regen_amount', 1)
+        if archetype.regenerates and attacker.alive:
+            regen_amount = archetype.regen_amount
             attacker.hp = min(attacker.max_hp, attacker.hp + regen_amount)
-            self.add_message(f"{attacker.name} regenerates {regen_amount} HP!")
-            self.add_to_log(f"{attacker.name} regenerates {regen_amount} HP")
+            self.events.record("regenerate", attacker.name, amount=regen_amount)
         
         # Handle double attack for goblins
-        if (hasattr(attacker, 'special') and 'double_attack_chance' in attacker.special and
-            random.random() < attacker.special['double_attack_chance'] and
-            attacker != self.player):
-            self.add_message(f"{attacker.name} attacks twice!")
-            self.add_to_log(f"{attacker.name} attacks twice!")
+        if archetype.double_attacks and self.rng.random() < archetype.double_attack_chance:
+            self.events.record("double_attack", attacker.name)
             return True  # Signal to attack again
         
         return False
@@ -874,58 +2455,53 @@ class Game:
     def fight(self, entity):
         # Player attacks first
         player_damage = self.calculate_damage(self.player, entity)
-        entity.show_health = True  # Show health bar when attacked
-        entity.health_bar_time = pygame.time.get_ticks()  # Reset timer
+        entity.health_bar_time = pygame.time.get_ticks()  # Show health bar when attacked
         
         # Check for dodge
-        if hasattr(entity, 'special') and 'dodge_chance' in entity.special:
-            if random.random() < entity.special['dodge_chance']:
-                self.add_message(f"{entity.name} dodged your attack!")
-                self.add_to_log(f"{entity.name} dodged your attack!")
+        if entity.archetype.dodges:
+            if self.rng.random() < entity.archetype.dodge_chance:
+                self.events.record("dodged", target=entity.name)
             else:
                 entity.hp -= player_damage
-                self.add_message(f"You hit {entity.name} for {player_damage} damage!")
-                self.add_to_log(f"You hit {entity.name} for {player_damage} damage!")
+                self.events.record("hit", target=entity.name, amount=player_damage)
         else:
             entity.hp -= player_damage
-            self.add_message(f"You hit {entity.name} for {player_damage} damage!")
-            self.add_to_log(f"You hit {entity.name} for {player_damage} damage!")
+            self.events.record("hit", target=entity.name, amount=player_damage)
         
         # Handle special effects from player's attack
         self.handle_special_effects(self.player, entity)
         
         if entity.hp <= 0:
-            entity.alive = False
-            self.entities.remove(entity)
-            self.player.exp += entity.exp
-            self.add_message(f"You defeated {entity.name}! Gained {entity.exp} XP.")
-            self.add_to_log(f"You defeated {entity.name}! Gained {entity.exp} XP.")
+            x, y, name, exp = entity.x, entity.y, entity.name, entity.exp
+            self.remove_entity(entity)  # The handle is dead from here on
+            self.player.exp += exp
+            self.events.record("defeated", target=name, amount=exp)
             
             # Check level up
             if self.player.exp >= self.player.next_level:
-                level_up_msg = self.player.level_up()
-                self.add_message(level_up_msg)
-                self.add_to_log(level_up_msg)
+                self.player.level_up()
+                
+                # Increase agro range in the game by 0.5 per level (rounded up)
+                self.enemy_agro_range = math.ceil(self.player.level * 0.5)
+                self.events.record("level_up", amount=self.player.level)
             
             # Move to enemy's position after defeating it
-            self.player.x, self.player.y = entity.x, entity.y
+            self.player.x, self.player.y = x, y
             self.update_fov()
         else:
             # Enemy attacks if alive
             if entity.alive:
                 # Check for player dodge
                 player_dodge_chance = 0.1 + (self.player.level * 0.01)
-                if random.random() < player_dodge_chance:
-                    self.add_message(f"You dodged {entity.name}'s attack!")
-                    self.add_to_log(f"You dodged {entity.name}'s attack!")
+                if self.rng.random() < player_dodge_chance:
+                    self.events.record("evaded", entity.name)
                 else:
                     # Enemy may attack multiple times (goblins)
                     attack_again = True
                     while attack_again:
                         enemy_damage = self.calculate_damage(entity, self.player)
                         self.player.hp -= enemy_damage
-                        self.add_message(f"{entity.name} hits you for {enemy_damage} damage!")
-                        self.add_to_log(f"{entity.name} hits you for {enemy_damage} damage!")
+                        self.events.record("hurt", entity.name, amount=enemy_damage)
                         
                         # Handle special effects from enemy's attack
                         attack_again = self.handle_special_effects(entity, self.player)
@@ -933,7 +2509,7 @@ class Game:
                         if self.player.hp <= 0:
                             self.player.hp = 0
                             self.game_state = "game_over"
-                            self.add_message("You have been defeated! Press R to restart")
+                            self.events.record("killed")
                             return True
         
         return False
@@ -943,118 +2519,165 @@ class Game:
 
 
     def calculate_damage(self, attacker, defender):
+        archetype = attacker.archetype  # The player's has no abilities
+        is_player = attacker is self.player
+        
         # Calculate effective defense
-        effective_defense = max(0, defender.defense - getattr(attacker, 'armor_pen', 0))
+        effective_defense = max(0, defender.defense - archetype.armor_pen)
         
         # Apply accuracy bonus if attacker has it
-        attack_bonus = attacker.special.get("accuracy_bonus", 0) if hasattr(attacker, 'special') else 0
-        base_attack = max(1, attacker.attack + attack_bonus - effective_defense // 2)
+        base_attack = max(1, attacker.attack + archetype.accuracy_bonus - effective_defense // 2)
         
         # Critical hits
-        if (attacker == self.player or 
-            (hasattr(attacker, 'special') and 'crit_chance' in attacker.special)):
-            crit_chance = self.player.crit_chance if attacker == self.player else attacker.special['crit_chance']
-            crit_multiplier = self.player.crit_multiplier if attacker == self.player else attacker.special['crit_multiplier']
+        if is_player or archetype.crits:
+            crit_chance = self.player.crit_chance if is_player else archetype.crit_chance
+            crit_multiplier = self.player.crit_multiplier if is_player else archetype.crit_multiplier
             
-            if random.random() < crit_chance:
+            if self.rng.random() < crit_chance:
                 base_attack = int(base_attack * crit_multiplier)
-                if attacker == self.player:
-                    self.add_message("Critical hit!")
-                    self.add_to_log("Critical hit!")
+                if is_player:
+                    self.events.record("critical")
                 else:
-                    self.add_message(f"{attacker.name} lands a critical hit!")
-                    self.add_to_log(f"{attacker.name} lands a critical hit!")
+                    self.events.record("enemy_critical", attacker.name)
         
         # Random variance
-        damage = max(1, base_attack + random.randint(-1, 2))
+        damage = max(1, base_attack + self.rng.randint(-1, 2))
         
         # Handle life drain for ghosts
-        if (hasattr(attacker, 'special') and 'life_drain' in attacker.special and 
-            attacker != self.player and damage > 0):
-            heal_amount = int(damage * attacker.special['life_drain'])
+        if archetype.drains and damage > 0:
+            heal_amount = int(damage * archetype.life_drain)
             attacker.hp = min(attacker.max_hp, attacker.hp + heal_amount)
-            self.add_message(f"{attacker.name} drains {heal_amount} health!")
-            self.add_to_log(f"{attacker.name} drains {heal_amount} health!")
+            self.events.record("drain", attacker.name, amount=heal_amount)
         
         return damage
 
 
     def handle_poison(self):
+        if self.recorder is not None:
+            self.recorder.record(ACTION_POISON)
         if self.player.poisoned and self.player.poison_duration > 0:
             self.player.hp -= self.player.poison_damage
             self.player.poison_duration -= 1
-            self.add_message(f"You take {self.player.poison_damage} poison damage! ({self.player.poison_duration} turns remaining)")
-            self.add_to_log(f"Poison damage: -{self.player.poison_damage} HP")
+            self.events.record("poison", amount=self.player.poison_damage, extra=self.player.poison_duration)
             
             if self.player.poison_duration <= 0:
                 self.player.poisoned = False
-                self.add_message("The poison has worn off!")
-                self.add_to_log("Poison effect ended")
+                self.events.record("poison_ended")
             
             if self.player.hp <= 0:
                 self.player.hp = 0
                 self.game_state = "game_over"
-                self.add_message("You have been defeated by poison! Press R to restart")
+                self.events.record("poison_killed")
 
 
     def pick_up_item(self, item):
-        self.items.remove(item)
-        
-        if hasattr(item, 'effect'):
-            if item.effect == "gold":
-                self.player.gold += item.amount
-                if item.name == "Treasure":
-                    self.add_message(f"You found a treasure chest with {item.amount} gold! (Total: {self.player.gold})")
-                    self.add_to_log(f"Found treasure worth {item.amount} gold")
-                else:
-                    self.add_message(f"You picked up {item.amount} gold! (Total: {self.player.gold})")
-                    self.add_to_log(f"Picked up {item.amount} gold")
-            elif item.effect == "heal":
-                heal_amount = min(item.amount, self.player.max_hp - self.player.hp)
-                self.player.hp += heal_amount
-                self.add_message(f"You used {item.name} and healed {heal_amount} HP!")
-                self.add_to_log(f"You used {item.name} and healed {heal_amount} HP!")
-            elif item.effect == "attack":
-                self.player.attack += item.amount
-                self.add_message(f"You equipped {item.name}! Attack + {item.amount}.")
-                self.add_to_log(f"You equipped {item.name}! Attack + {item.amount}.")
-            elif item.effect == "defense":
-                self.player.defense += item.amount
-                self.player.max_hp += item.amount * 2
-                self.player.hp += item.amount * 2
-                self.add_message(f"You equipped {item.name}! Defense + {item.amount} and max HP + {item.amount * 2}.")
-                self.add_to_log(f"You equipped {item.name}! Defense + {item.amount} and max HP + {item.amount * 2}.")
-
-
-
-
-
-
-    def add_message(self, msg):
-        self.message = msg
-        self.message_time = pygame.time.get_ticks()
-
-
-
-
-
-
-    def add_to_log(self, entry):
-        # Split multi-line entries and add them in order
-        for line in entry.split('\n'):
-            self.combat_log.append(line)
-        # Trim log if it gets too long
-        if len(self.combat_log) > self.max_log_entries:
-            self.combat_log = self.combat_log[-self.max_log_entries:]
-
-
-
-
-
+        _, _, name, effect = ITEM_KINDS[item.kind]
+        amount = item.amount
+        self.remove_item(item)
+        
+        if effect == "gold":
+            self.player.gold += amount
+            if name == "Treasure":
+                self.events.record("treasure", amount=amount, extra=self.player.gold)
+            else:
+                self.events.record("gold", amount=amount, extra=self.player.gold)
+        elif effect == "heal":
+            heal_amount = min(amount, self.player.max_hp - self.player.hp)
+            self.player.hp += heal_amount
+            self.events.record("heal", target=name, amount=heal_amount)
+        elif effect == "attack":
+            self.player.attack += amount
+            self.events.record("attack", target=name, amount=amount)
+        elif effect == "defense":
+            self.player.defense += amount
+            self.player.max_hp += amount * 2
+            self.player.hp += amount * 2
+            self.events.record("defense", target=name, amount=amount, extra=amount * 2)
+
+
+
+
+
+
+    def collect_dirty_regions(self):
+        """Compare what would be drawn with the last presented frame; returns whether anything changed"""
+        now = pygame.time.get_ticks()
+        presenter = self.presenter
+        fov_box = self.fov_box or (0, 0, 0, 0)
+        entities = [e for e in self.entity_index.in_rect(*fov_box) if self.tiles.visible[e.y, e.x]]
+        items = [i for i in self.item_index.in_rect(*fov_box) if self.tiles.visible[i.y, i.x]]
+        
+        # Map, actors and minimap: a change anywhere here repaints the whole screen
+        view = (self.camera_x, self.camera_y, self.tiles.version, self.game_state,
+                self.player.x, self.player.y, id(self.player.sprite),
+                tuple((id(e), e.x, e.y) for e in entities),
+                tuple((id(i), i.x, i.y) for i in items))
+        full = presenter.check("view", view, screen.get_rect())
+        
+        # HUD widgets
+        player = self.player
+        hud = (player.hp, player.max_hp, player.level, player.exp, player.next_level, player.attack,
+               player.defense, player.crit_chance, player.vision_radius, player.gold, self.dungeon_level)
+        presenter.check("hud", hud, (0, SCREEN_HEIGHT - 120, SCREEN_WIDTH, 120))
+        presenter.check("log", (self.events.floor, self.events.count), (10, 10, 300, 230))
+        
+        # Expiring message
+        message = self.events.last if now - self.events.last_time < MESSAGE_DURATION else None
+        presenter.check("message", message, (0, SCREEN_HEIGHT - 45, SCREEN_WIDTH, 45))
+        
+        # Fading enemy health bars
+        bar_height = max(4, GRID_SIZE // 8)
+        bars = set()
+        for entity in entities:
+            bars.add(id(entity))
+            rect = (entity.x * GRID_SIZE - self.camera_x - 1, entity.y * GRID_SIZE - self.camera_y - bar_height - 1,
+                    GRID_SIZE + 2, bar_height + 2)
+            presenter.check(id(entity), (entity.health_bar_shown(now), entity.hp), rect)
+        # Frame timings overlay (None while hidden, so hiding it repaints what was under it)
+        rows = self.profiler.overlay_rows(now) if self.profiler.overlay else None
+        presenter.check("profiler", rows, PROFILER_RECT)
+        presenter.forget(bars | {"view", "hud", "log", "message", "profiler"})
+        
+        if full:
+            presenter.rects = [screen.get_rect()]
+        return bool(presenter.rects)
 
     def draw(self):
-        # Clear screen
-        screen.fill(BLACK)
+        # Turn-based: most frames nothing changes, so skip drawing and presenting them
+        if not self.collect_dirty_regions():
+            return
+        
+        self.draw_map()
+        self.draw_actors()
+        
+        # Draw UI
+        self.draw_ui()
+        
+        # Draw message
+        message = self.events.message(pygame.time.get_ticks())
+        if message is not None:
+            msg_surface = text_cache.render(font_medium, message, WHITE)
+            screen.blit(msg_surface, (10, SCREEN_HEIGHT - 40))
+        
+        # Draw game over screen
+        if self.game_state == "game_over":
+            self.draw_game_over()
+            
+        # Draw minimap
+        if self.game_state == "playing":
+            self.draw_minimap()
+        
+        # Draw frame timings
+        if self.profiler.overlay:
+            self.draw_profiler()
+            
+        # Only send the regions that changed to the display
+        self.presenter.present()
+
+    def draw_map(self):
+        # Clear screen (the map layer covers all of it unless the map is smaller than the screen)
+        if self.map_width * GRID_SIZE < SCREEN_WIDTH or self.map_height * GRID_SIZE < SCREEN_HEIGHT:
+            screen.fill(BLACK)
         
         # Calculate visible area
         start_x = max(0, self.camera_x // GRID_SIZE)
@@ -1062,49 +2685,36 @@ class Game:
         end_x = min(self.map_width, (self.camera_x + SCREEN_WIDTH) // GRID_SIZE + 1)
         end_y = min(self.map_height, (self.camera_y + SCREEN_HEIGHT) // GRID_SIZE + 1)
         
-        # Draw map
-        for y in range(start_y, end_y):
-            for x in range(start_x, end_x):
-                screen_x = x * GRID_SIZE - self.camera_x
-                screen_y = y * GRID_SIZE - self.camera_y
-                tile = self.tiles[y][x]
-                
-                if tile.visible:
-                    # Currently visible tiles - draw normally
-                    if tile.type == 0:  # Wall
-                        pygame.draw.rect(screen, self.wall_color, (screen_x, screen_y, GRID_SIZE, GRID_SIZE))
-                    elif tile.type == 1:  # Floor
-                        pygame.draw.rect(screen, self.floor_color, (screen_x, screen_y, GRID_SIZE, GRID_SIZE))
-                    elif tile.type == 2:  # Exit/Door
-                        try:
-                            # Load and draw the exit sprite if available
-                            exit_sprite = load_base64_image(EXIT_IMAGE)
-                            screen.blit(exit_sprite, (screen_x, screen_y))
-                        except Exception as e:
-                            # Fallback to simple representation if sprite fails to load
-                            print(f"Failed to load exit sprite: {e}")  # Debug message
-                            pygame.draw.rect(screen, YELLOW, (screen_x, screen_y, GRID_SIZE, GRID_SIZE))
-                            exit_text = font_medium.render("E", True, BLACK)
-                            screen.blit(exit_text, (screen_x, screen_y))
-                elif tile.explored:
-                    # Previously explored but not currently visible - draw darkened
-                    if tile.type == 0:  # Wall
-                        dark_wall = tuple(c // 2 for c in self.wall_color)
-                        pygame.draw.rect(screen, dark_wall, (screen_x, screen_y, GRID_SIZE, GRID_SIZE))
-                    elif tile.type == 1 or tile.type == 2:  # Floor or Exit
-                        dark_floor = tuple(c // 2 for c in self.floor_color)
-                        pygame.draw.rect(screen, dark_floor, (screen_x, screen_y, GRID_SIZE, GRID_SIZE))
-                    
-
-        # Draw entities and items (only if visible)
-        for entity in self.entities:
-            if self.tiles[entity.y][entity.x].visible:
+        # Draw map: repaint changed tiles in the cached layer, then blit the viewport
+        self.map_layer.refresh(self.tiles)
+        self.map_layer.draw(screen, self.camera_x, self.camera_y, start_x, start_y, end_x, end_y)
+        
+        # The exit is the only tile drawn with a sprite
+        exit_x, exit_y = self.exit_pos
+        if (start_x <= exit_x < end_x and start_y <= exit_y < end_y and
+            self.tiles.visible[exit_y, exit_x] and self.tiles.type[exit_y, exit_x] == 2):
+            screen_x = exit_x * GRID_SIZE - self.camera_x
+            screen_y = exit_y * GRID_SIZE - self.camera_y
+            exit_sprite = sprite_cache.get("Exit")
+            if exit_sprite is not None:
+                screen.blit(exit_sprite, (screen_x, screen_y))
+            else:
+                # Fallback to simple representation if sprite fails to load
+                pygame.draw.rect(screen, YELLOW, (screen_x, screen_y, GRID_SIZE, GRID_SIZE))
+                exit_text = text_cache.render(font_medium, "E", BLACK)
+                screen.blit(exit_text, (screen_x, screen_y))
+
+    def draw_actors(self):
+        # Draw entities and items (only if visible, so only those inside the FOV box)
+        fov_box = self.fov_box or (0, 0, 0, 0)
+        for entity in self.entity_index.in_rect(*fov_box):
+            if self.tiles.visible[entity.y, entity.x]:
                 screen_x = entity.x * GRID_SIZE - self.camera_x
                 screen_y = entity.y * GRID_SIZE - self.camera_y
                 entity.draw(screen, screen_x, screen_y, GRID_SIZE)
         
-        for item in self.items:
-            if self.tiles[item.y][item.x].visible:
+        for item in self.item_index.in_rect(*fov_box):
+            if self.tiles.visible[item.y, item.x]:
                 screen_x = item.x * GRID_SIZE - self.camera_x
                 screen_y = item.y * GRID_SIZE - self.camera_y
                 item.draw(screen, screen_x, screen_y, GRID_SIZE)
@@ -1113,24 +2723,6 @@ class Game:
         screen_x = self.player.x * GRID_SIZE - self.camera_x
         screen_y = self.player.y * GRID_SIZE - self.camera_y
         self.player.draw(screen, screen_x, screen_y, GRID_SIZE)
-        
-        # Draw UI
-        self.draw_ui()
-        
-        # Draw message
-        if pygame.time.get_ticks() - self.message_time < 3000:  # Show message for 3 seconds
-            msg_surface = font_medium.render(self.message, True, WHITE)
-            screen.blit(msg_surface, (10, SCREEN_HEIGHT - 40))
-        
-        # Draw game over screen
-        if self.game_state == "game_over":
-            self.draw_game_over()
-            
-        # Draw minimap
-        if self.game_state == "playing":
-            self.draw_minimap()
-            
-        pygame.display.flip()
 
 
 
@@ -1138,8 +2730,7 @@ class Game:
 
     def draw_ui(self):
         # Draw semi-transparent UI panel with border
-        ui_panel = pygame.Surface((SCREEN_WIDTH, 120), pygame.SRCALPHA)
-        ui_panel.fill((0, 0, 0, 200))  # Slightly darker background
+        ui_panel = translucent_panel((SCREEN_WIDTH, 120), (0, 0, 0, 200))  # Slightly darker background
         screen.blit(ui_panel, (0, SCREEN_HEIGHT - 120))
         
         # Draw health bar centered at bottom
@@ -1168,17 +2759,17 @@ class Game:
                         bar_width * health_ratio - 4, bar_height - 4))
         
         # Health text centered above bar
-        health_text = font_small.render(f"HP: {self.player.hp}/{self.player.max_hp}", True, (220, 220, 220))
+        health_text = text_cache.render(font_small, f"HP: {self.player.hp}/{self.player.max_hp}", (220, 220, 220))
         health_text_x = SCREEN_WIDTH // 2 - health_text.get_width() // 2
         screen.blit(health_text, (health_text_x, health_bar_y - 25))
         
         # Draw level under left side of health bar
-        level_text = font_small.render(f"Level: {self.player.level}", True, WHITE)
+        level_text = text_cache.render(font_small, f"Level: {self.player.level}", WHITE)
         level_x = health_bar_x
         screen.blit(level_text, (level_x, health_bar_y + bar_height + 5))
         
         # Draw experience under right side of health bar
-        xp_text = font_small.render(f"XP: {self.player.exp}/{self.player.next_level}", True, WHITE)
+        xp_text = text_cache.render(font_small, f"XP: {self.player.exp}/{self.player.next_level}", WHITE)
         xp_x = health_bar_x + bar_width - xp_text.get_width()
         screen.blit(xp_text, (xp_x, health_bar_y + bar_height + 5))
         
@@ -1207,43 +2798,53 @@ class Game:
             column_x = start_x + (col_idx * column_spacing)
             
             for row_idx, stat in enumerate(column_stats):
-                stat_text = font_small.render(stat, True, WHITE)
+                stat_text = text_cache.render(font_small, stat, WHITE)
                 screen.blit(stat_text, (column_x, SCREEN_HEIGHT - 100 + row_idx * 22))
         
         # Draw combat log (now positioned at top left)
-        log_panel = pygame.Surface((300, 230), pygame.SRCALPHA)
-        log_panel.fill((0, 0, 0, 150))
+        log_panel = translucent_panel((300, 230), (0, 0, 0, 150))
         screen.blit(log_panel, (10, 10))  # Positioned at top left with 10px padding
 
-        log_title = font_small.render("Combat Log:", True, WHITE)
+        log_title = text_cache.render(font_small, "Combat Log:", WHITE)
         screen.blit(log_title, (20, 15))  # Slightly indented from panel edge
 
         # Display most recent entries in chronological order (oldest at top)
         y_offset = 35  # Start below title
-        lines_to_show = min(10, len(self.combat_log))  # Show up to 10 lines
-        start_index = max(0, len(self.combat_log) - lines_to_show)  # Start index for last 10 entries
+        combat_log = self.events.lines()
+        lines_to_show = min(10, len(combat_log))  # Show up to 10 lines
+        start_index = max(0, len(combat_log) - lines_to_show)  # Start index for last 10 entries
 
-        for i in range(start_index, len(self.combat_log)):
-            log_entry = font_small.render(self.combat_log[i], True, WHITE)
+        for i in range(start_index, len(combat_log)):
+            log_entry = text_cache.render(font_small, combat_log[i], WHITE)
             screen.blit(log_entry, (20, y_offset))  # Indented from panel edge
             y_offset += 20
         
         # Draw controls
-        controls = font_small.render("WASD: Move     Q: Quit     R: Restart", True, WHITE)
+        controls = text_cache.render(font_small, "WASD: Move     Q: Quit     R: Restart", WHITE)
         screen.blit(controls, (SCREEN_WIDTH - 300, SCREEN_HEIGHT - 30))
 
+    def draw_profiler(self):
+        # Frame timings (F3): one row per phase, numbers right-aligned in their columns
+        x, y, width, height = PROFILER_RECT
+        screen.blit(translucent_panel((width, height), (0, 0, 0, 150)), (x, y))
+        for row_idx, row in enumerate(self.profiler.overlay_rows(pygame.time.get_ticks())):
+            row_y = y + 5 + row_idx * 20
+            screen.blit(text_cache.render(font_small, row[0], WHITE), (x + 10, row_y))
+            for col_idx, cell in enumerate(row[1:]):
+                cell_text = text_cache.render(font_small, cell, WHITE)
+                screen.blit(cell_text, (x + 170 + col_idx * 60 - cell_text.get_width(), row_y))
+
 
 
 
     def draw_game_over(self):
-        overlay = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SRCALPHA)
-        overlay.fill((0, 0, 0, 200))
+        overlay = translucent_panel((SCREEN_WIDTH, SCREEN_HEIGHT), (0, 0, 0, 200))
         screen.blit(overlay, (0, 0))
         
-        game_over_text = font_large.render("GAME OVER", True, RED)
+        game_over_text = text_cache.render(font_large, "GAME OVER", RED)
         screen.blit(game_over_text, (SCREEN_WIDTH//2 - game_over_text.get_width()//2, SCREEN_HEIGHT//2 - 50))
         
-        restart_text = font_medium.render("Press R to restart or Q to quit", True, WHITE)
+        restart_text = text_cache.render(font_medium, "Press R to restart or Q to quit", WHITE)
         screen.blit(restart_text, (SCREEN_WIDTH//2 - restart_text.get_width()//2, SCREEN_HEIGHT//2 + 20))
     
 
@@ -1252,49 +2853,15 @@ class Game:
 
 
     def draw_minimap(self):
-        # Create minimap surface
-        minimap = pygame.Surface((MINIMAP_WIDTH, MINIMAP_HEIGHT), pygame.SRCALPHA)
-        minimap.fill((0, 0, 0, 150))  # Semi-transparent black background
-        
         # Calculate visible area on minimap
         start_x = max(0, self.player.x - MINIMAP_WIDTH // (2 * MINIMAP_CELL_SIZE))
         start_y = max(0, self.player.y - MINIMAP_HEIGHT // (2 * MINIMAP_CELL_SIZE))
         end_x = min(self.map_width, start_x + MINIMAP_WIDTH // MINIMAP_CELL_SIZE)
         end_y = min(self.map_height, start_y + MINIMAP_HEIGHT // MINIMAP_CELL_SIZE)
         
-        # Draw explored tiles
-        for y in range(start_y, end_y):
-            for x in range(start_x, end_x):
-                if self.tiles[y][x].explored:
-                    # Calculate position on minimap
-                    map_x = (x - start_x) * MINIMAP_CELL_SIZE
-                    map_y = (y - start_y) * MINIMAP_CELL_SIZE
-                    
-                    # Choose color based on tile type
-                    if self.tiles[y][x].type == 0:  # Wall
-                        color = self.wall_color
-                    elif self.tiles[y][x].type == 1:  # Floor
-                        color = self.floor_color
-                    elif self.tiles[y][x].type == 2:  # Exit
-                        color = BLACK
-                    
-                    # Darken if not currently visible
-                    if not self.tiles[y][x].visible:
-                        color = tuple(c // 2 for c in color)
-                    
-                    pygame.draw.rect(minimap, color, 
-                                    (map_x, map_y, MINIMAP_CELL_SIZE, MINIMAP_CELL_SIZE))
-        
-        # Draw player position
-        player_map_x = (self.player.x - start_x) * MINIMAP_CELL_SIZE
-        player_map_y = (self.player.y - start_y) * MINIMAP_CELL_SIZE
-        pygame.draw.rect(minimap, GREEN, 
-                        (player_map_x, player_map_y, MINIMAP_CELL_SIZE, MINIMAP_CELL_SIZE))
-        
-        # Draw a border around the minimap
-        pygame.draw.rect(minimap, WHITE, (0, 0, MINIMAP_WIDTH, MINIMAP_HEIGHT), 1)
-        
-        # Blit the minimap to the screen
+        # Repaint tiles that changed since the last frame, then blit the (cached) panel
+        self.minimap.refresh(self.tiles)
+        minimap = self.minimap.render(start_x, start_y, end_x, end_y, self.player.x, self.player.y)
         screen.blit(minimap, MINIMAP_POSITION)
 
 
@@ -1302,8 +2869,35 @@ class Game:
 
 
 
+    def chase_map(self):
+        """Steps to the player around their tile, as (distances, left, top) of the covered area"""
+        # One breadth-first search per turn serves every enemy, however many are chasing
+        px, py = self.player.x, self.player.y
+        key = (px, py, self.enemy_agro_range, self.tiles.version)
+        if key != self.chase_key:
+            reach = self.enemy_agro_range + CHASE_MARGIN
+            left, top = max(0, px - reach), max(0, py - reach)
+            right, bottom = min(self.map_width, px + reach + 1), min(self.map_height, py + reach + 1)
+            walkable = self.tiles.type[top:bottom, left:right] != 0
+            self.chase = (distance_map(walkable, px - left, py - top), left, top)
+            self.chase_key = key
+        return self.chase
+
+    def nearby_enemies(self, after):
+        """Enemies close enough to act this turn, in spawn order, that spawned after seq `after`"""
+        # Only enemies within health bar or agro range of the player do anything;
+        # the rest of the level is never looked at
+        reach = max(5, self.enemy_agro_range)
+        nearby = [e for e in self.entity_index.near(self.player.x, self.player.y, reach) if e.seq > after]
+        nearby.sort(key=lambda e: e.seq)
+        return nearby
+
     def move_enemies(self):
-        for entity in self.entities:
+        active = self.nearby_enemies(0)
+        i = 0
+        while i < len(active):
+            entity = active[i]
+            i += 1
             if not entity.alive:
                 continue
                 
@@ -1314,56 +2908,55 @@ class Game:
             
             # Show health bar when enemy is close
             if distance <= 5:  # Show health when within 5 tiles
-                entity.show_health = True
                 entity.health_bar_time = pygame.time.get_ticks()
             
             # Only move if within agro range
-            if distance > game.enemy_agro_range:
+            if distance > self.enemy_agro_range:
                 continue
                 
-            # Normalize direction (move 1 step toward player)
-            move_x = 0
-            move_y = 0
-            if dx > 0:
-                move_x = -1
-            elif dx < 0:
-                move_x = 1
-                
-            if dy > 0:
-                move_y = -1
-            elif dy < 0:
-                move_y = 1
-                
-            # Randomly choose to move horizontally or vertically if both are possible
-            if move_x != 0 and move_y != 0:
-                if random.random() < 0.5:
-                    move_y = 0
-                else:
-                    move_x = 0
-                    
-            new_x = entity.x + move_x
-            new_y = entity.y + move_y
+            # Step downhill on the distance map, which leads around walls
+            chase, left, top = self.chase_map()
+            height, width = chase.shape
+            here = chase[entity.y - top, entity.x - left]
+            if here < 0:
+                continue  # No way to the player inside the chase area
             
-            # Check if new position is valid
-            if (0 <= new_x < self.map_width and 
-                0 <= new_y < self.map_height and 
-                self.tiles[new_y][new_x].type != 0):  # Not a wall
+            steps = []
+            for move_x, move_y in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+                new_x = entity.x + move_x
+                new_y = entity.y + move_y
+                if not (0 <= new_x - left < width and 0 <= new_y - top < height):
+                    continue
+                if chase[new_y - top, new_x - left] != here - 1:
+                    continue
                 
                 # Check if position is occupied by another entity
-                occupied = False
-                for other in self.entities:
-                    if other is not entity and other.x == new_x and other.y == new_y and other.alive:
-                        occupied = True
-                        break
-                        
-                # Check if position is the player's position
-                if (new_x, new_y) == (self.player.x, self.player.y):
-                    self.fight(entity)
-                    continue
-                    
-                if not occupied:
-                    entity.x = new_x
-                    entity.y = new_y
+                other = self.entity_index.at(new_x, new_y)
+                if other is None or other is entity or not other.alive:
+                    steps.append((new_x, new_y))
+            if not steps:
+                continue
+            
+            # Randomly choose between equally short steps
+            if len(steps) > 1:
+                new_x, new_y = steps[int(self.rng.random() * len(steps))]
+            else:
+                new_x, new_y = steps[0]
+            
+            # Check if position is the player's position
+            if (new_x, new_y) == (self.player.x, self.player.y):
+                seq = entity.seq
+                self.fight(entity)
+                if not entity.alive:
+                    # The player stepped onto the enemy and may have levelled up, so
+                    # look for the remaining enemies again. Like the original walk over
+                    # the enemies in spawn order, the next one spawned loses its turn
+                    after = self.alive_by_seq.find(1, seq + 1)
+                    active = self.nearby_enemies(seq if after < 0 else after)
+                    i = 0
+                continue
+            
+            self.entity_index.move(entity, new_x, new_y)
 
 
 
@@ -1374,54 +2967,106 @@ class Game:
 
 
 
-    def run(self):
+    def next_wakeup(self, now, move_due, poison_due):
+        """Ticks at which the loop has to run again even without input (None if nothing is pending)"""
+        deadlines = [t for t in (move_due, poison_due) if t is not None]
+        
+        # Message expiry
+        if self.events.last is not None and now - self.events.last_time < MESSAGE_DURATION:
+            deadlines.append(self.events.last_time + MESSAGE_DURATION)
+        
+        # Health bar fade, for the enemies in sight (the others aren't drawn)
+        for entity in self.entity_index.in_rect(*(self.fov_box or (0, 0, 0, 0))):
+            if self.tiles.visible[entity.y, entity.x] and entity.health_bar_shown(now):
+                deadlines.append(entity.health_bar_time + HEALTH_BAR_DURATION)
+        
+        return min(deadlines) if deadlines else None
+
+
+
+    def run(self, trace=None, idle_wait=True):
+        # Start whatever hasn't been started yet
+        if screen is None:
+            init_display()
+        ensure_fonts()
+        
         running = True
         self.update_fov()
         move_delay = 100  # in milliseconds
         last_move_time = 0
         last_poison_time = 0
         poison_interval = 1000  # poison damage every second
+        pending = []  # Event that woke up an idle wait
+        profiler = self.profiler
 
         while running:
+            if profiler.enabled:
+                profiler.begin_frame()
             current_time = pygame.time.get_ticks()
+            self.events.now = current_time  # Messages recorded this turn are timed from here
             
             # Handle poison damage
             if current_time - last_poison_time >= poison_interval and self.player.poisoned:
                 self.handle_poison()
                 last_poison_time = current_time
             
-            for event in pygame.event.get():
-                if event.type == QUIT:
+            for event in pending + pygame.event.get():
+                if event.type == pygame.QUIT:
                     running = False
-                if event.type == KEYDOWN:
-                    if event.key == K_q:
+                if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                    self.presenter.invalidate_all()
+                if event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_q:
                         running = False
-                    elif event.key == K_r:
-                        game = Game()
-                        return game.run()
+                    elif event.key == pygame.K_r:
+                        # Restart in place: sprites, fonts and surfaces stay loaded
+                        self.reset()
+                        self.presenter.invalidate_all()
+                        last_move_time = 0
+                        last_poison_time = 0
+                    elif event.key == pygame.K_F3:
+                        profiler.toggle_overlay(self)
+            pending = []
+            if profiler.enabled:
+                profiler.lap("input")
 
             # Key hold movement (continuous movement)
+            dx, dy = 0, 0
             if self.game_state == "playing":
-                keys = pygame.key.get_pressed()
+                dx, dy = held_direction(pygame.key.get_pressed())
                 if current_time - last_move_time >= move_delay:
-                    dx, dy = 0, 0
-                    if keys[K_w] or keys[K_UP]:
-                        dy = -1
-                    elif keys[K_s] or keys[K_DOWN]:
-                        dy = 1
-                    elif keys[K_a] or keys[K_LEFT]:
-                        dx = -1
-                    elif keys[K_d] or keys[K_RIGHT]:
-                        dx = 1
                     if dx != 0 or dy != 0:
                         self.move_player(dx, dy)
                         last_move_time = current_time
+                        if self.autosave:
+                            self.save(self.autosave)
 
             # Always update and draw, regardless of game state
             self.update_camera()
             self.draw()
+            if trace:
+                trace.report("first frame")
+                trace = None
+            if profiler.enabled:
+                profiler.end_frame()
+            
+            if idle_wait and running:
+                # Sleep until a key event or the next scheduled change (held-key move,
+                # poison tick, message expiry, health bar fade) instead of polling
+                now = pygame.time.get_ticks()
+                move_due = last_move_time + move_delay if (dx != 0 or dy != 0) else None
+                poison_due = last_poison_time + poison_interval if self.player.poisoned else None
+                wakeup = self.next_wakeup(now, move_due, poison_due)
+                timeout = IDLE_WAKEUP if wakeup is None else min(IDLE_WAKEUP, wakeup - now)
+                if timeout > 0:
+                    event = pygame.event.wait(timeout)
+                    if event.type != pygame.NOEVENT:
+                        pending = [event]
             clock.tick(FPS)
 
+        profiler.close()
+        if self.recorder is not None:
+            self.recorder.close()
         pygame.quit()
         sys.exit()
 
@@ -1430,7 +3075,313 @@ class Game:
 
 
 
+def read_save(path):
+    """Map a save file into memory and return its sections as NumPy views (see Game.save)"""
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    if data[:len(SAVE_MAGIC)] != SAVE_MAGIC:
+        raise ValueError(f"{path} is not a save file")
+    
+    save = {}
+    offset = 0
+    def section(name, dtype, count):
+        nonlocal offset
+        save[name] = np.frombuffer(data, dtype, count, offset)
+        offset += save[name].nbytes
+    
+    section("header", np.dtype(SAVE_HEADER), 1)
+    header = save["header"] = save["header"][0]
+    if header["version"] != SAVE_VERSION:
+        raise ValueError(f"{path} is a version {header['version']} save, expected {SAVE_VERSION}")
+    
+    width, height = int(header["width"]), int(header["height"])
+    chunks_x, chunks_y = -(-width // TileMap.CHUNK), -(-height // TileMap.CHUNK)
+    section("player", np.dtype(SAVE_PLAYER), 1)
+    save["player"] = save["player"][0]
+    section("types_low", np.uint8, -(-width * height // 8))
+    section("types_high", np.uint8, -(-width * height // 8))
+    section("explored", np.uint8, chunks_y * chunks_x * TileMap.CHUNK * TileMap.CHUNK // 8)
+    save["explored"] = save["explored"].reshape(chunks_y, chunks_x, TileMap.CHUNK, TileMap.CHUNK // 8)
+    if header["exit_chunk_x"] >= 0:
+        section("generated", np.uint8, -(-chunks_x * chunks_y // 8))
+        section("gate_x", np.uint8, chunks_x * chunks_y)
+        section("gate_y", np.uint8, chunks_x * chunks_y)
+        save["gate_x"] = save["gate_x"].reshape(chunks_y, chunks_x)
+        save["gate_y"] = save["gate_y"].reshape(chunks_y, chunks_x)
+    section("enemies", np.dtype(SAVE_ENEMY), int(header["enemies"]))
+    section("items", np.dtype(SAVE_ITEM), int(header["items"]))
+    return save
+
+
+
+def load_game(path):
+    """Create a Game from a save file"""
+    save = read_save(path)
+    game = Game(int(save["header"]["width"]), int(save["header"]["height"]), generate=False)
+    game.load(save)
+    return game
+
+
+
+
+
+
+# Writes the actions played in a game to a replay file (see REPLAY_HEADER), from the
+# state the game is in when recording starts, which must be the one Game(width,
+# height, seed) starts in. The game records through Game.recorder.
+class Recorder:
+    def __init__(self, path, game, checkpoint_interval=REPLAY_CHECKPOINT_INTERVAL):
+        if not 0 <= game.seed < 2 ** 64:
+            raise ValueError(f"can't record a game with seed {game.seed} (must be 0 to 2**64 - 1)")
+        self.game = game
+        self.checkpoint_interval = checkpoint_interval
+        self.actions = 0  # Actions recorded so far
+        self.file = open(path, "wb")
+        header = np.zeros((), np.dtype(REPLAY_HEADER))
+        header["magic"] = REPLAY_MAGIC
+        header["version"] = REPLAY_VERSION
+        header["width"], header["height"] = game.map_width, game.map_height
+        header["seed"] = game.seed
+        self.file.write(header.tobytes())
+        self.checkpoint()
+
+    def record(self, action):
+        """Called by the game just before it plays action"""
+        if self.actions and self.actions % self.checkpoint_interval == 0:
+            self.checkpoint()
+        self.file.write(bytes((action,)))
+        self.actions += 1
+
+    def checkpoint(self):
+        self.file.write(bytes((REPLAY_CHECKPOINT,)) + self.game.state_hash())
+        self.file.flush()  # What was played so far survives a crash
+
+    def close(self):
+        self.checkpoint()
+        self.file.close()
+
+
+
+def read_replay(path):
+    """Read a replay file; returns its header and the actions and checkpoints after it"""
+    with open(path, "rb") as f:
+        data = f.read()
+    
+    if data[:len(REPLAY_MAGIC)] != REPLAY_MAGIC:
+        raise ValueError(f"{path} is not a replay file")
+    header = np.frombuffer(data, np.dtype(REPLAY_HEADER), 1)[0]
+    if header["version"] != REPLAY_VERSION:
+        raise ValueError(f"{path} is a version {header['version']} replay, expected {REPLAY_VERSION}")
+    return header, data[header.nbytes:]
+
+
+
+
+
+
+# Scripted player for headless runs: walks towards the exit, fighting or picking up
+# whatever is in the way, with the occasional random step
+class AutoPlayer:
+    DIRECTIONS = [(0, -1), (0, 1), (-1, 0), (1, 0)]
+
+    def __init__(self, rng, wander_chance=0.1):
+        self.rng = rng
+        self.wander_chance = wander_chance  # Chance to take a random step instead
+        self.distances = None  # Steps to the exit from every tile (None = unreachable)
+        self.distances_key = None  # (game, dungeon level, tiles version) the distances belong to
+
+    def exit_distances(self, game):
+        """Breadth-first search from the exit over every walkable tile"""
+        width, height = game.map_width, game.map_height
+        walkable = (game.tiles.type != 0).tolist()
+        distances = [[None] * width for _ in range(height)]
+        exit_x, exit_y = game.exit_pos
+        distances[exit_y][exit_x] = 0
+        queue = deque([(exit_x, exit_y)])
+        while queue:
+            x, y = queue.popleft()
+            step = distances[y][x] + 1
+            for dx, dy in self.DIRECTIONS:
+                nx, ny = x + dx, y + dy
+                if 0 <= nx < width and 0 <= ny < height and walkable[ny][nx] and distances[ny][nx] is None:
+                    distances[ny][nx] = step
+                    queue.append((nx, ny))
+        return distances
+
+    def next_move(self, game):
+        key = (game, game.dungeon_level, game.tiles.version)
+        if key != self.distances_key:
+            self.distances = self.exit_distances(game)
+            self.distances_key = key
+        
+        if self.rng.random() < self.wander_chance:
+            return self.rng.choice(self.DIRECTIONS)
+        
+        # Step to the neighbour closest to the exit
+        best_move, best_distance = None, None
+        for dx, dy in self.DIRECTIONS:
+            nx, ny = game.player.x + dx, game.player.y + dy
+            if 0 <= nx < game.map_width and 0 <= ny < game.map_height:
+                distance = self.distances[ny][nx]
+                if distance is not None and (best_distance is None or distance < best_distance):
+                    best_move, best_distance = (dx, dy), distance
+        return best_move or self.rng.choice(self.DIRECTIONS)
+
+
+
+def run_headless(turns, seed=None, trace=None, record=None):
+    """Play the game rules without a window, audio, fonts or sprites and report throughput"""
+    trace = trace or StartupTrace()
+    sprite_cache.enabled = False
+    bot = AutoPlayer(random.Random(seed))
+    with trace.phase("first level"):
+        game = Game(seed=seed)
+    if record:
+        game.recorder = Recorder(record, game)
+    trace.report("first turn")
+    sessions = 1
+    deepest = 1
+    
+    start = time.perf_counter()
+    for turn in range(1, turns + 1):
+        if game.game_state == "game_over":
+            # Start a fresh session when the player dies
+            game.reset()
+            sessions += 1
+        
+        if turn % HEADLESS_POISON_INTERVAL == 0 and game.player.poisoned:
+            game.handle_poison()
+        game.move_player(*bot.next_move(game))
+        deepest = max(deepest, game.dungeon_level)
+    elapsed = time.perf_counter() - start
+    if game.recorder is not None:
+        game.recorder.close()
+    
+    print(f"{turns} turns in {elapsed:.2f}s ({turns / elapsed:.0f} turns/s), "
+          f"{sessions} session(s), deepest dungeon level {deepest}")
+
+
+
+def run_replay(path):
+    """Play a replay file back headless and as fast as possible, checking every checkpoint
+
+    Returns whether the game went through the same states as when it was recorded.
+    """
+    sprite_cache.enabled = False
+    header, stream = read_replay(path)
+    game = Game(int(header["width"]), int(header["height"]), int(header["seed"]))
+    actions = checkpoints = 0
+    
+    start = time.perf_counter()
+    position = 0
+    while position < len(stream):
+        action = stream[position]
+        if action == REPLAY_CHECKPOINT:
+            recorded = stream[position + 1:position + 9]
+            state = game.state_hash()
+            if state != recorded:
+                print(f"replay diverged after {actions} actions: state {state.hex()}, recorded {recorded.hex()}")
+                return False
+            checkpoints += 1
+            position += 9
+        else:
+            game.play(action)
+            actions += 1
+            position += 1
+    elapsed = time.perf_counter() - start
+    
+    print(f"{actions} actions replayed in {elapsed:.2f}s ({actions / max(elapsed, 1e-9):.0f} actions/s), "
+          f"{checkpoints} checkpoints matched, dungeon level {game.dungeon_level}")
+    return True
+
+
+
+def map_size(text):
+    """Parse a --map-size value: WIDTHxHEIGHT, or a single number for a square map"""
+    try:
+        width, _, height = text.lower().partition("x")
+        width, height = int(width), int(height or width)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid map size: {text!r}")
+    if not (MAP_SIZE <= width <= 4000 and MAP_SIZE <= height <= 4000):
+        raise argparse.ArgumentTypeError(f"map sides must be between {MAP_SIZE} and 4000 tiles")
+    return width, height
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dark Dungeon")
+    parser.add_argument("--headless", action="store_true",
+                        help="run the game rules without a window and report turns per second")
+    parser.add_argument("--seed", type=int, help="seed for the random number generator")
+    parser.add_argument("--turns", type=int, default=10000, help="number of turns to play in headless mode")
+    parser.add_argument("--map-size", type=map_size, default=(MAP_SIZE, MAP_SIZE),
+                        help="size of the dungeon levels, e.g. 2000x2000 (windowed mode; larger than "
+                             f"{MAP_SIZE}x{MAP_SIZE} is generated in chunks as you explore)")
+    parser.add_argument("--load", metavar="PATH", help="continue the game saved in PATH")
+    parser.add_argument("--autosave", metavar="PATH", help="save the game to PATH after every turn")
+    parser.add_argument("--busy-loop", action="store_true",
+                        help="redraw at a fixed FPS instead of sleeping until input arrives")
+    parser.add_argument("--startup-trace", action="store_true", help="print how long each startup phase took")
+    parser.add_argument("--perf-log", metavar="PATH",
+                        help="write how long each phase of every frame took to PATH (CSV if it ends in "
+                             ".csv, else one JSON object per line)")
+    parser.add_argument("--record", metavar="PATH",
+                        help="write the seed and every action played to PATH, for --replay")
+    parser.add_argument("--replay", metavar="PATH",
+                        help="play a --record file back headless as fast as possible, checking it plays out the same")
+    args = parser.parse_args(argv)
+    if args.record and args.load:
+        parser.error("--record starts from a new game, it can't be combined with --load")
+    if args.record and args.seed is not None and not 0 <= args.seed < 2 ** 64:
+        parser.error("--record needs a --seed between 0 and 2**64 - 1")
+    
+    trace = StartupTrace(args.startup_trace)
+    trace.record("import", time.perf_counter() - _IMPORT_START)
+    
+    if args.replay:
+        try:
+            matched = run_replay(args.replay)
+        except (OSError, ValueError) as e:
+            parser.error(f"can't replay {args.replay}: {e}")
+        if not matched:
+            sys.exit(1)
+        return
+    
+    if args.headless:
+        run_headless(args.turns, args.seed, trace, args.record)
+        return
+    
+    # Only the window is needed up front; fonts and music load while the first level is generated
+    with trace.phase("display"):
+        init_display()
+    start_background_init(trace)
+    with trace.phase("first level"):
+        try:
+            game = load_game(args.load) if args.load else Game(*args.map_size, args.seed)
+        except (OSError, ValueError) as e:
+            parser.error(f"can't load {args.load}: {e}")
+    game.autosave = args.autosave
+    if args.record:
+        try:
+            game.recorder = Recorder(args.record, game)
+        except OSError as e:
+            parser.error(f"can't write {args.record}: {e}")
+    if args.perf_log:
+        try:
+            game.profiler.open_log(args.perf_log, game)
+        except OSError as e:
+            parser.error(f"can't write {args.perf_log}: {e}")
+    with trace.phase("wait for fonts"):
+        ensure_fonts()
+    game.run(trace, idle_wait=not args.busy_loop)
+
+
+
+
+
+
 # Run the game
 if __name__ == "__main__":
-    game = Game()
-    game.run()
+    main()
@@ -0,0 +1,160 @@
+"""Monte-Carlo duels between the player and one enemy kind, for balancing.
+
+    python simulate.py [--duels 100000] [--enemies goblin orc ...]
+                       [--dungeon-levels 1 5 10] [--player-levels 1 3 5] [--seed 1]
+
+Every duel is the player bumping into the enemy until one of them dies, with the
+rules of Game.fight, Game.calculate_damage, Game.handle_special_effects and
+Game.handle_poison. The duels run side by side as NumPy arrays, one round at a time.
+"""
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import time
+import argparse
+
+import numpy as np
+
+import rogue
+
+
+MAX_ROUNDS = 1000  # Duels still going after this many rounds count as lost
+
+
+
+def player_at(level):
+    """A fresh, fully healed player who has levelled up to level"""
+    rogue.sprite_cache.enabled = False
+    player = rogue.Player(0, 0)
+    for _ in range(level - 1):
+        player.level_up()
+    player.hp = player.max_hp
+    return player
+
+
+
+def simulate(enemy_type, dungeon_level, player_level, duels, rng):
+    """Run duels against ENEMY_TYPES[enemy_type]; returns (win rate, mean rounds to kill, mean damage taken)
+
+    A round is one Game.fight: poison ticks (once per round, where the game ticks it once
+    a second), then the player attacks, then the enemy strikes back if it survived.
+    Damage taken counts hits and poison ticks until the duel ends, at most the player's HP.
+    """
+    player = player_at(player_level)
+    archetype = rogue.enemy_archetype(enemy_type, dungeon_level)
+    dodge_chance = archetype.dodge_chance if archetype.dodges else 0
+    crit_chance = archetype.crit_chance if archetype.crits else 0
+    crit_multiplier = archetype.crit_multiplier
+    accuracy_bonus = archetype.accuracy_bonus
+    life_drain = archetype.life_drain if archetype.drains else 0
+    poison_chance = archetype.poison_chance if archetype.poisons else 0
+    poison_damage = archetype.poison_damage
+    poison_duration = archetype.poison_duration
+    regen_amount = archetype.regen_amount if archetype.regenerates else 0
+    double_attack_chance = archetype.double_attack_chance if archetype.double_attacks else 0
+    player_dodge_chance = 0.1 + player.level * 0.01
+
+    # Enemy stats, rolled as in LevelBuilder.place_entities
+    enemy_hp, enemy_attack, enemy_defense, _ = (
+        rng.integers(low, high + 1, duels) + offset for low, high, offset in archetype.stats)
+    enemy_max_hp = enemy_hp.copy()
+
+    # The player's hit doesn't depend on the enemy beyond its defense, nor the enemy's on the player
+    player_base = np.maximum(1, player.attack - enemy_defense // 2)
+    enemy_base = np.maximum(1, enemy_attack + accuracy_bonus - max(0, player.defense - archetype.armor_pen) // 2)
+
+    hp = np.full(duels, player.hp)
+    poison_left = np.zeros(duels, dtype=np.int64)  # Poison ticks still to come
+    taken = np.zeros(duels, dtype=np.int64)
+
+    index = np.arange(duels)  # Duel each live entry belongs to
+    won = np.zeros(duels, dtype=bool)
+    rounds = np.zeros(duels, dtype=np.int64)
+    damage_taken = np.zeros(duels, dtype=np.int64)
+
+    for round_number in range(1, MAX_ROUNDS + 1):
+        # Poison tick
+        poisoned = poison_left > 0
+        hp -= np.where(poisoned, poison_damage, 0)
+        taken += np.where(poisoned, poison_damage, 0)
+        poison_left -= poisoned
+        killed = hp <= 0
+
+        # Player attack
+        count = len(hp)
+        crit = rng.random(count) < player.crit_chance
+        damage = np.where(crit, (player_base * player.crit_multiplier).astype(np.int64), player_base)
+        damage = np.maximum(1, damage + rng.integers(-1, 3, count))
+        if dodge_chance:
+            damage[rng.random(count) < dodge_chance] = 0
+        enemy_hp -= np.where(killed, 0, damage)
+        win = ~killed & (enemy_hp <= 0)
+
+        # Enemy attack, repeated while it rolls a double attack
+        attacking = ~killed & ~win & (rng.random(count) >= player_dodge_chance)
+        while attacking.any():
+            crit = rng.random(count) < crit_chance
+            damage = np.where(crit, (enemy_base * crit_multiplier).astype(np.int64), enemy_base)
+            damage = np.maximum(1, damage + rng.integers(-1, 3, count))
+            damage = np.where(attacking, damage, 0)
+            if life_drain:
+                enemy_hp = np.minimum(enemy_max_hp, enemy_hp + (damage * life_drain).astype(np.int64))
+            hp -= damage
+            taken += damage
+            if poison_chance:
+                poisoned = attacking & (rng.random(count) < poison_chance)
+                poison_left[poisoned] = poison_duration
+            if regen_amount:
+                enemy_hp = np.where(attacking, np.minimum(enemy_max_hp, enemy_hp + regen_amount), enemy_hp)
+            killed |= attacking & (hp <= 0)
+            attacking &= (hp > 0) & (rng.random(count) < double_attack_chance)
+
+        # Record finished duels and drop them
+        done = killed | win
+        if round_number == MAX_ROUNDS:
+            done[:] = True
+        finished = index[done]
+        won[finished] = win[done]
+        rounds[finished] = round_number
+        damage_taken[finished] = np.minimum(taken[done], player.hp)  # The game stops at 0 HP
+        live = ~done
+        if not live.any():
+            break
+        index, hp, poison_left, taken = index[live], hp[live], poison_left[live], taken[live]
+        enemy_hp, enemy_max_hp = enemy_hp[live], enemy_max_hp[live]
+        player_base, enemy_base = player_base[live], enemy_base[live]
+
+    wins = won.sum()
+    return (wins / duels, rounds[won].mean() if wins else float("nan"), damage_taken.mean())
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dark Dungeon combat simulator")
+    parser.add_argument("--duels", type=int, default=100000, help="duels per enemy kind and level pair")
+    parser.add_argument("--enemies", nargs="+", choices=rogue.ENEMY_TYPES, default=rogue.ENEMY_TYPES,
+                        help="enemy kinds to fight")
+    parser.add_argument("--dungeon-levels", nargs="+", type=int, default=[1, 5, 10], help="dungeon levels")
+    parser.add_argument("--player-levels", nargs="+", type=int, default=[1, 3, 5], help="player levels")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the random number generator")
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'enemy':<9} {'dungeon':>7} {'player':>6} {'win %':>6} {'rounds':>6} {'taken':>6}")
+    start = time.perf_counter()
+    for name in args.enemies:
+        for dungeon_level in args.dungeon_levels:
+            for player_level in args.player_levels:
+                win_rate, rounds, taken = simulate(rogue.ENEMY_TYPES.index(name), dungeon_level,
+                                                   player_level, args.duels, rng)
+                rounds = f"{rounds:>6.2f}" if win_rate else f"{'-':>6}"
+                print(f"{name:<9} {dungeon_level:>7} {player_level:>6} {win_rate * 100:>6.1f} {rounds} {taken:>6.1f}")
+    elapsed = time.perf_counter() - start
+    total = args.duels * len(args.enemies) * len(args.dungeon_levels) * len(args.player_levels)
+    print(f"{total} duels in {elapsed:.2f}s ({total / elapsed * 60 / 1e6:.1f} million duels per minute)")
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+"""Replay tests, run with pytest without a window or audio."""
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import random
+
+import pytest
+
+import rogue
+
+
+
+def test_replay_without_sprites_of_game_recorded_with_them(tmp_path):
+    """Facing is game state: a recording made in a window replays headless"""
+    pytest.importorskip("PIL")
+    path = tmp_path / "game.ddrp"
+    rogue.init_display()
+    rogue.sprite_cache.enabled = True
+    game = rogue.Game(seed=7)
+    assert game.player.sprite is not None
+    game.recorder = rogue.Recorder(path, game, checkpoint_interval=20)
+    bot = rogue.AutoPlayer(random.Random(7))
+    for _ in range(500):
+        if game.game_state == "game_over":
+            game.reset()
+        game.move_player(*bot.next_move(game))
+    game.recorder.close()
+
+    # run_replay turns sprites off, as headless runs do
+    assert rogue.run_replay(path)